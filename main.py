@@ -1,26 +1,32 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import json
+import importlib.util
 import os
 import platform
 import subprocess
 import re
+import textwrap
+import hashlib
+import threading
+import asyncio
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
 from typing import List, Dict, Optional
+from dataclasses import dataclass, field
 import logging
 from escpos.printer import Usb, Network, Dummy, Win32Raw
-from escpos.exceptions import USBNotFoundError, Error
+from escpos.exceptions import USBNotFoundError, Error, ImageWidthError
 from escpos.image import EscposImage
 import usb.core
-import socket
 import tempfile
 from io import BytesIO
-from PIL import Image
-import html2text
-import qrcode
-import base64
+from PIL import Image, ImageChops, UnidentifiedImageError
+import binascii
 from bs4 import BeautifulSoup
 
 # Configurar logging
@@ -35,6 +41,66 @@ except ImportError:
     WIN32_AVAILABLE = False
     logger.warning("win32print no disponible - algunas funciones de impresión limitadas")
 
+# Sistema operativo, no cambia en tiempo de ejecución
+PLATFORM_SYSTEM = platform.system()
+
+# Importación condicional de win32com (consultas WMI sin lanzar PowerShell)
+try:
+    import win32com.client
+    WIN32COM_AVAILABLE = True
+except ImportError:
+    WIN32COM_AVAILABLE = False
+
+# Parser HTML: lxml (C) si está instalado, si no el parser puro de Python
+if importlib.util.find_spec("lxml") is not None:
+    HTML_PARSER = "lxml"
+else:
+    HTML_PARSER = "html.parser"
+    logger.warning("lxml no disponible - usando html.parser (más lento)")
+
+# Importación condicional de orjson (lectura de config.json más rápida)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Importación condicional de selectolax (parser HTML en C, mucho más rápido que BeautifulSoup)
+try:
+    from selectolax.lexbor import LexborHTMLParser
+    SELECTOLAX_AVAILABLE = True
+except ImportError:
+    SELECTOLAX_AVAILABLE = False
+
+# Comandos ESC/POS precalculados
+# ESC ! n - selección de modo/tamaño de impresión, indexado por n
+SIZE_CMD = tuple(b"\x1b\x21" + bytes([n]) for n in range(256))
+# ESC 3 n - espaciado entre líneas
+LINE_SPACING_CMD = {
+    "compact": b"\x1b\x33\x0a",  # n = 10 (muy compacto)
+    "normal": b"\x1b\x33\x32",   # n = 50 (por defecto)
+    "wide": b"\x1b\x33\x3c",     # n = 60 (amplio)
+}
+# Secuencias fijas usadas por tablas y líneas horizontales
+ESC_SIZE_LARGE = SIZE_CMD[5]         # Tamaño de las filas de tabla
+ESC_SIZE_RESET = SIZE_CMD[0]
+ESC_LINE_SPACING_5 = b"\x1b\x33\x05"  # Interlineado mínimo antes de un <hr>
+ESC_BOLD_ON = b"\x1b\x45\x01"
+ESC_BOLD_OFF = b"\x1b\x45\x00"
+
+# Comandos ESC a n (alineación)
+ALIGN_CMD = {"left": b"\x1b\x61\x00", "center": b"\x1b\x61\x01", "right": b"\x1b\x61\x02"}
+
+# Expresiones regulares precompiladas para estilos inline
+_STYLE_WH = re.compile(r"(width|height)\s*:\s*(\d+)px")
+_HR_DOUBLE_RE = re.compile(r"border-style\s*:\s*double")
+_HR_DOTTED_RE = re.compile(r"border-style\s*:\s*dotted")
+_HR_DASHED_RE = re.compile(r"border-style\s*:\s*dashed")
+# Celdas de tabla: caracteres que marcan contenido numérico
+_CURRENCY_CHARS = frozenset('0123456789$€£¥₹.,')
+# Valor de width en style
+_RE_WIDTH_VAL = re.compile(r'^(\d+(?:\.\d+)?)\s*(px|ch|em|%)?$')
+
 
 app = FastAPI(
     title="PrintPOS API",
@@ -49,34 +115,9 @@ app.add_middleware(
     allow_credentials=False,  # Debe ser False cuando allow_origins=["*"]
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    max_age=86400,  # Cachear el preflight un día en el navegador
 )
 
-# Middleware adicional para CORS universal
-@app.middleware("http")
-async def add_cors_headers(request: Request, call_next):
-    # Manejar solicitudes OPTIONS preflight
-    if request.method == "OPTIONS":
-        response = Response()
-        response.headers.update({
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-            "Access-Control-Allow-Headers": "*",
-            "Access-Control-Max-Age": "86400"
-        })
-        return response
-    
-    # Procesar solicitud normal
-    response = await call_next(request)
-    
-    # Agregar headers CORS a todas las respuestas
-    response.headers.update({
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS", 
-        "Access-Control-Allow-Headers": "*"
-    })
-    
-    return response
-
 # Modelos Pydantic
 class PrintRequest(BaseModel):
     printer: str
@@ -108,8 +149,12 @@ class StatusResponse(BaseModel):
 # Cargar configuración
 def load_config():
     try:
-        with open('config.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open('config.json', 'rb') as f:
+            data = f.read()
+        if ORJSON_AVAILABLE:
+            # orjson.JSONDecodeError hereda de json.JSONDecodeError
+            return orjson.loads(data)
+        return json.loads(data)
     except FileNotFoundError:
         print("ERROR: El archivo config.json no fue encontrado en la carpeta actual.")
         logger.error("config.json no encontrado")
@@ -125,33 +170,66 @@ if not config:
     import sys
     sys.exit(1)
 
+def write_raw_to_printer(printer_name, data):
+    """Envía un bloque de bytes ESC/POS a la cola de Windows en una sola escritura"""
+    handle = win32print.OpenPrinter(printer_name)
+    try:
+        win32print.StartDocPrinter(handle, 1, ("PrintPOS", None, "RAW"))
+        try:
+            win32print.StartPagePrinter(handle)
+            win32print.WritePrinter(handle, data)
+            win32print.EndPagePrinter(handle)
+        finally:
+            win32print.EndDocPrinter(handle)
+    finally:
+        win32print.ClosePrinter(handle)
+
+# Caché LRU de tickets ya renderizados (reimpresiones, copias de cocina, etc.)
+RENDER_CACHE_SIZE = 256
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def render_ticket(html_content, paper_size="80mm", font_size='normal', test_width=False, line_spacing='normal'):
+    """Genera los bytes ESC/POS del ticket, corte incluido; un HTML repetido sale de la caché"""
+    key = (
+        hashlib.blake2b(html_content.encode("utf-8"), digest_size=16).digest(),
+        paper_size, font_size, test_width, line_spacing,
+    )
+    with _render_cache_lock:
+        output = _render_cache.get(key)
+        if output is not None:
+            _render_cache.move_to_end(key)
+            return output
+
+    # Generar todo el ticket en memoria: cada p.text/p.set/p._raw sobre Win32Raw
+    # sería una escritura independiente a la impresora
+    p = Dummy()
+    process_html_for_escpos(p, html_content, paper_size, font_size, test_width, line_spacing)
+    p.cut()
+    output = p.output
+
+    with _render_cache_lock:
+        _render_cache[key] = output
+        if len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return output
+
 def print_html(printer_name, html_content, paper_size="80mm", font_size='normal', test_width=False, line_spacing='normal'):    
     """Imprimir usando escpos con impresora del sistema"""
     # print(f"Imprimir usando escpos con impresora del sistema: {printer_name} (papel: {paper_size}, fuente: {font_size})")
     try:    
-        from escpos import printer    
-        # Intentar usar Win32Raw si está disponible
+        output = render_ticket(html_content, paper_size, font_size, test_width, line_spacing)
+
+        # Enviar el buffer completo en una sola escritura si win32print está disponible
         if WIN32_AVAILABLE:            
             try:
-                p = printer.Win32Raw(printer_name)
-                process_html_for_escpos(p, html_content, paper_size, font_size, test_width, line_spacing)                
-                # p.text("Grácias por usar PrintPOS!")
-                # p.text(str(content))
-            
-                # p.ln(2)
-                p.cut()
-                # p.clear()
-                p.close()
+                write_raw_to_printer(printer_name, output)
                 # print(f"Impresión ESCPOS exitosa en {printer_name} (papel: {paper_size}, fuente: {font_size})")
                 return True, f"Impresión ESCPOS exitosa en {printer_name} (papel: {paper_size}, fuente: {font_size})"
             except Exception as e:
                 logger.warning(f"Win32Raw falló: {e}")
         
-        # Fallback: usar Dummy printer_name para debug
-        p = printer.Dummy()
-        process_html_for_escpos(p, html_content, paper_size, font_size, test_width, line_spacing)
-        p.cut()
-        output = p.output
+        # Fallback: sin impresora real, solo mostrar el contenido para debug
         # print(f"Contenido que se enviaría a imprimir: {output[:200]}...")
         logger.info(f"Contenido que se enviaría a imprimir: {output[:200]}...")
         return True, f"Simulación de impresión en {printer_name} (papel: {paper_size}, fuente: {font_size}) (modo debug)"
@@ -160,7 +238,40 @@ def print_html(printer_name, html_content, paper_size="80mm", font_size='normal'
         logger.error(f"Error ESCPOS sistema: {e}")
         return False, f"Error en impresión ESCPOS: {str(e)}"
     
+def print_html_batch(printer_name, tickets):
+    """
+    Imprimir varios tickets (PrintRequest) en la misma impresora con un solo trabajo
+    de impresión; cada ticket conserva su corte. Devuelve un (success, message) por ticket
+    """
+    results = []
+    outputs = []
+    for ticket in tickets:
+        try:
+            outputs.append(render_ticket(ticket.html, ticket.size, ticket.font_size, ticket.test_width, ticket.line_spacing))
+            results.append(None)
+        except Exception as e:
+            logger.error(f"Error ESCPOS sistema: {e}")
+            results.append((False, f"Error en impresión ESCPOS: {str(e)}"))
+    if not outputs:
+        return results
+
+    output = b"".join(outputs)
+    # Enviar todos los tickets en una sola escritura si win32print está disponible
+    if WIN32_AVAILABLE:
+        try:
+            write_raw_to_printer(printer_name, output)
+            message = f"Impresión ESCPOS exitosa en {printer_name} ({len(outputs)} tickets en un solo trabajo)"
+            return [result or (True, message) for result in results]
+        except Exception as e:
+            logger.warning(f"Win32Raw falló: {e}")
 
+    # Fallback: sin impresora real, solo mostrar el contenido para debug
+    logger.info(f"Contenido que se enviaría a imprimir: {output[:200]}...")
+    message = f"Simulación de impresión en {printer_name} ({len(outputs)} tickets) (modo debug)"
+    return [result or (True, message) for result in results]
+
+
+@lru_cache(maxsize=None)
 def get_char_width(paper_size, font_size='normal', content_type='default'):
     """
     Retorna el número de caracteres por línea según el papel, fuente y tipo de contenido
@@ -217,732 +328,948 @@ def set_line_spacing(p, spacing='normal'):
         spacing: 'compact', 'normal', 'wide'
     """
     try:
-        if spacing == 'compact':
-            # Espaciado mínimo (ESC 3 n) - n = 10 (muy compacto)
-            p._raw(bytes([0x1B, 0x33, 10]))
-        elif spacing == 'wide':
-            # Espaciado amplio (ESC 3 n) - n = 60
-            p._raw(bytes([0x1B, 0x33, 60]))
-        else:  # normal
-            # Espaciado normal por defecto (ESC 3 n) - n = 50
-            p._raw(bytes([0x1B, 0x33, 50]))
+        p._raw(LINE_SPACING_CMD.get(spacing, LINE_SPACING_CMD["normal"]))
     except Exception as e:
         logger.warning(f"No se pudo configurar espaciado de líneas: {e}")
 
+# Línea numerada hasta 65 caracteres para la prueba de ancho
+_TEST_LINE = ("1234567890" * 7)[:65]
+
+# Separador de la prueba de ancho por tamaño de papel
+_TEST_SEPARATOR = {size: "=" * get_char_width(size, 'normal') + '\n' for size in ("58mm", "80mm")}
+
 def print_char_width_test(p, paper_size):
     """Imprime línea de prueba numerada para verificar el ancho real"""
     try:
         p.text(f"Prueba de ancho para papel {paper_size}:\n")
-        # Línea numerada hasta 65 caracteres
-        test_line = ''.join([str(i % 10) for i in range(1, 66)])
-        p.text(test_line + '\n')
+        p.text(_TEST_LINE + '\n')
         p.text("Marcar donde se corta la línea\n")
-        p.text("=" * get_char_width(paper_size, 'normal') + '\n')
+        separator = _TEST_SEPARATOR.get(paper_size)
+        if separator is None:
+            separator = "=" * get_char_width(paper_size, 'normal') + '\n'
+        p.text(separator)
         p.ln(2)
     except Exception as e:
         print(f"Error en prueba de ancho: {e}")
 
-def process_html_for_escpos(p, html_content, paper_size="80mm", font_size='normal', test_width=False, line_spacing='normal'):
-    """Procesa e imprime HTML con formato según el tamaño de papel y fuente"""
+# Tamaño ESC ! de cada encabezado (h1 = más grande, h6 = más pequeño)
+HEADING_SIZES = {"h1": 8, "h2": 7, "h3": 6, "h4": 5, "h5": 4, "h6": 3}
 
-    # Configurar espaciado de líneas al inicio
-    set_line_spacing(p, line_spacing)
 
-    # Obtener ancho de caracteres según papel y fuente
-    char_width = get_char_width(paper_size, font_size)
-    print(f"Ancho de caracteres para papel {paper_size} con fuente {font_size}: {char_width} caracteres por línea")
-    # Imprimir prueba de ancho si se solicita
-    if test_width:
-        print_char_width_test(p, paper_size)
-    
-    soup = BeautifulSoup(html_content, "html.parser")
+@dataclass
+class _PState:
+    """
+    Atributos de texto vigentes en la impresora (None = desconocido).
+    Permite omitir comandos ESC/POS que no cambian nada.
+    """
+    size: int = None
+    align: str = None
+    bold: bool = None
+    underline: int = None
+
+    def invalidate(self):
+        self.size = self.align = self.bold = self.underline = None
+
+
+def _emit_size(p, st, n):
+    """Envía ESC ! n solo si cambia el estado de la impresora"""
+    # ESC ! también fija negrita (bit 3) y subrayado (bit 7)
+    bold = bool(n & 0x08)
+    underline = 1 if n & 0x80 else 0
+    if st.size == n and st.bold == bold and st.underline == underline:
+        return
+    p._raw(SIZE_CMD[n])
+    st.size, st.bold, st.underline = n, bold, underline
+
+
+def _emit_style(p, st, align=None, bold=None, underline=None):
+    """Equivalente a p.set(align, bold, underline) enviando solo los atributos que cambian"""
+    changes = {}
+    if align is not None and align != st.align:
+        changes["align"] = align
+    if bold is not None and bold != st.bold:
+        changes["bold"] = bold
+    if underline is not None and underline != st.underline:
+        changes["underline"] = underline
+    if changes:
+        p.set(**changes)
+        for key, value in changes.items():
+            setattr(st, key, value)
+
+
+def emit_centered(p, st, text):
+    """Imprime una línea centrada y vuelve a alinear a la izquierda"""
+    if text.isascii():
+        # ASCII es igual en todas las páginas de códigos: una sola escritura
+        prefix = b"" if st.align == "center" else ALIGN_CMD["center"]
+        p._raw(prefix + text.encode("ascii") + b"\n" + ALIGN_CMD["left"])
+        st.align = "left"
+    else:
+        # El codificador de python-escpos elige la página de códigos
+        _emit_style(p, st, align="center")
+        p.text(text + "\n")
+        _emit_style(p, st, align="left")
+
+
+@dataclass
+class RenderContext:
+    """Parámetros del ticket compartidos por los manejadores de elementos"""
+    paper_size: str
+    font_size: str
+    line_spacing: str
+    char_width: int
+    # False si la impresora no entiende ESC a / ESC ! (modo Star): centrar con espacios
+    raw_format: bool = True
+    # Ancho de las líneas horizontales (<hr> y filas separadoras de tabla)
+    hr_width: int = 0
+    state: _PState = field(default_factory=_PState)
+
+
+def _emit_heading(p, ctx, text, size, bold=True, underline=None):
+    """Imprime un encabezado centrado con tamaño ESC ! size y restablece el formato"""
+    st = ctx.state
+    if ctx.raw_format:
+        _emit_style(p, st, align="center", bold=bold, underline=underline)
+        # Aplicar tamaño usando comando ESC ! directo
+        if size > 1:
+            _emit_size(p, st, size)
+        p.text(text + "\n")  # Usar salto simple en lugar de p.ln()
+        # Resetear tamaño y formato
+        _emit_size(p, st, 0)  # Reset tamaño
+        _emit_style(p, st, align="left", bold=False)
+    else:
+        # Fallback: centrado manual
+        padding = max(0, (ctx.char_width - len(text)) // 2)
+        _emit_style(p, st, bold=True)
+        if size > 1:
+            _emit_size(p, st, size)
+        p.text(" " * padding + text + "\n")  # Reducir salto doble
+        _emit_size(p, st, 0)  # Reset tamaño
+        _emit_style(p, st, bold=False)
+
+
+def _handle_heading(element, p, ctx):
+    """Encabezados h1 - h6"""
+    # print(f"Procesando encabezado: {element.name}")
+    # Configurar tamaño según el tipo de encabezado (h1=más grande, h6=más pequeño)
+    size = HEADING_SIZES.get(element.name, 1)
+    text = element.get_text(strip=True)
+    _emit_heading(p, ctx, text, size, bold=False, underline=0)
+
+
+def _handle_paragraph(element, p, ctx):
+    """Párrafos"""
+    _emit_style(p, ctx.state, align="left", bold=False, underline=0)
+    _emit_size(p, ctx.state, 1)
+    text = element.get_text(strip=True)
     
-    # DEBUG: Mostrar longitud del HTML y primeros caracteres
-    # print(f"HTML DEBUG: Longitud: {len(html_content)} caracteres")
-    # print(f"HTML DEBUG: Primeros 200 chars: {html_content[:200]}")
+    # Ancho para párrafos: el ancho 'default' ya calculado para el ticket
+    paragraph_width = ctx.char_width
     
-    # DEBUG: Mostrar todos los elementos img encontrados
-    img_elements = soup.find_all("img")
-    # print(f"DEBUG: Elementos <img> encontrados: {len(img_elements)}")
-    for i, img in enumerate(img_elements):
-        src = img.get('src', 'NO SRC')
-        # print(f"DEBUG: IMG {i+1}: src={src[:50]}...")
-
-    def process_element(element):
-        """Procesa un elemento HTML de manera recursiva evitando duplicaciones"""
-        if not hasattr(element, 'name') or element.name is None:
-            return
-        
-        element_name = element.name.lower()
-        # print(f"DEBUG: Procesando elemento: {element_name}")
-
-        # Encabezados h1 - h6
-        if element_name in [f"h{i}" for i in range(1, 7)]:
-            # print(f"Procesando encabezado: {element.name}")
-            # Configurar tamaño según el tipo de encabezado (h1=más grande, h6=más pequeño)
-            if element_name == "h1":
-                width_size = 8
-                height_size = 8
-            elif element_name == "h2":                
-                width_size = 7
-                height_size = 7
-            elif element_name == "h3":                
-                width_size = 6
-                height_size = 6
-            elif element_name == "h4":                
-                width_size = 5
-                height_size = 5
-            elif element_name == "h5":                
-                width_size = 4
-                height_size = 4
-            elif element_name == "h6":                
-                width_size = 3
-                height_size = 3
-            else:
-                width_size = 1
-                height_size = 1
-            
-            text = element.get_text(strip=True)
-            # print(f"Encabezado texto: {text} - Tamaño: {width_size}x{height_size}")
-            
-            # Aplicar formato y tamaño
-            try:
-                # Aplicar formato con tamaño
-                p.set(align="center", bold=False, underline=0)
-                # Aplicar tamaño usando comando ESC ! directo
-                if width_size > 1 or height_size > 1:
-                    # size_param = ((width_size - 1) << 8) | (height_size - 1)
-                    size_param = width_size
-                    p._raw(bytes([0x1B, 0x21, size_param]))
-                p.text(text)
-                p.text("\n")  # Usar salto simple en lugar de p.ln()
-                # Resetear tamaño y formato
-                p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                p.set(align="left", bold=False)
-            except:
-                # Fallback: centrado manual
-                padding = max(0, (char_width - len(text)) // 2)
-                p.set(bold=True)
-                if width_size > 1 or height_size > 1:
-                    # size_param = ((width_size - 1) << 4) | (height_size - 1)
-                    size_param = width_size
-                    p._raw(bytes([0x1B, 0x21, size_param]))
-                p.text(" " * padding + text + "\n")  # Reducir salto doble
-                p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                p.set(bold=False)
-
-        # Párrafos
-        elif element_name == "p":
-            p.set(align="left", bold=False, underline=0)
-            p._raw(bytes([0x1B, 0x21, 1]))
-            text = element.get_text(strip=True)
-            
-            # Obtener ancho dinámico para párrafos (puede ser diferente según contexto)
-            paragraph_width = get_char_width(paper_size, font_size, 'default')
-            
-            # Ajustar texto al ancho dinámico
-            if len(text) > paragraph_width:
-                # Dividir texto largo en líneas con algoritmo mejorado
-                words = text.split()
-                lines = []
-                current_line = ""
-                for word in words:
-                    test_line = current_line + (" " + word if current_line else word)
-                    if len(test_line) <= paragraph_width:
-                        current_line = test_line
-                    else:
-                        if current_line:
-                            lines.append(current_line)
-                            current_line = word
-                        else:
-                            # Palabra muy larga, dividir por caracteres
-                            lines.append(word[:paragraph_width])
-                            current_line = word[paragraph_width:] if len(word) > paragraph_width else ""
-                if current_line:
-                    lines.append(current_line)
-                p.text("\n".join(lines) + "\n")
+    # Ajustar texto al ancho dinámico
+    if len(text) > paragraph_width:
+        # Dividir texto largo en líneas; las palabras más largas que el ancho se parten
+        lines = textwrap.wrap(text, paragraph_width, break_long_words=True, break_on_hyphens=False)
+        p.text("\n".join(lines) + "\n")
+    else:
+        p.text(text + "\n")
+
+
+def _handle_center(element, p, ctx):
+    """Centrados - procesar elementos hijos en lugar de imprimir directamente"""
+    char_width = ctx.char_width
+    # Procesar cada hijo del elemento center
+    for child in element.children:
+        if getattr(child, 'name', None):
+            # Es un elemento HTML
+            child_name = child.name
+            if child_name in HEADING_SIZES:
+                # Encabezado centrado
+                text = child.get_text(strip=True)
+                # print(f"Encabezado centrado: {child_name} - {text}")
+                _emit_heading(p, ctx, text, HEADING_SIZES[child_name])
             else:
-                p.text(text + "\n")
-
-        # Centrados - procesar elementos hijos en lugar de imprimir directamente
-        elif element_name == "center":
-            # Procesar cada hijo del elemento center
-            for child in element.children:
-                if hasattr(child, 'name') and child.name:
-                    # Es un elemento HTML
-                    child_name = child.name.lower()
-                    if child_name in [f"h{i}" for i in range(1, 7)]:
-                        # Encabezado centrado
-                        if child_name == "h1":
-                            width_size, height_size = 8, 8
-                        elif child_name == "h2":
-                            width_size, height_size = 7, 7
-                        elif child_name == "h3":
-                            width_size, height_size = 6, 6
-                        elif child_name == "h4":
-                            width_size, height_size = 5, 5
-                        elif child_name == "h5":
-                            width_size, height_size = 4, 4
-                        elif child_name == "h6":
-                            width_size, height_size = 3, 3
-                        else:
-                            width_size, height_size = 1, 1
-                        
-                        text = child.get_text(strip=True)
-                        # print(f"Encabezado centrado: {child_name} - {text} - Tamaño: {width_size}x{height_size}")
-                        
-                        try:
-                            p.set(align="center", bold=True)
-                            # Aplicar tamaño usando comando ESC ! directo
-                            if width_size > 1 or height_size > 1:
-                                # Calcular parámetro para ESC !
-                                # Bits 0-3: altura (1-8), Bits 4-7: ancho (1-8)
-                                # size_param = ((width_size - 1) << 4) | (height_size - 1)
-                                size_param = width_size
-                                p._raw(bytes([0x1B, 0x21, size_param]))
-                            p.text(text)
-                            p.text("\n")  # Usar salto simple
-                            # Reset tamaño y formato
-                            p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                            p.set(align="left", bold=False)
-                        except:
-                            padding = max(0, (char_width - len(text)) // 2)
-                            p.set(bold=True)
-                            if width_size > 1 or height_size > 1:
-                                # size_param = ((width_size - 1) << 4) | (height_size - 1)
-                                size_param = width_size
-                                p._raw(bytes([0x1B, 0x21, size_param]))
-                            p.text(" " * padding + text + "\n")
-                            p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                            p.set(bold=False)
-                    else:
-                        # Otros elementos centrados
-                        text = child.get_text(strip=True)
-                        if text:
-                            # print(f"Texto centrado: {text}")
-                            try:
-                                p.set(align="center")
-                                p.text(text)
-                                p.text("\n")  # Usar salto simple
-                                p.set(align="left")
-                            except:
-                                padding = max(0, (char_width - len(text)) // 2)
-                                p.text(" " * padding + text + "\n")
-                elif hasattr(child, 'strip'):
-                    # Es texto plano
-                    text = child.strip()
-                    if text:
-                        # print(f"Texto plano centrado: {text}")
-                        try:
-                            p.set(align="center")
-                            p.text(text)
-                            p.text("\n")  # Usar salto simple
-                            p.set(align="left")
-                        except:
-                            padding = max(0, (char_width - len(text)) // 2)
-                            p.text(" " * padding + text + "\n")
-
-        # Elementos con estilo text-align center
-        elif element.get('style') and 'text-align:center' in element.get('style', ''):
-            text = element.get_text(strip=True)
-            if text:
-                # print(f"Elemento con text-align center: {element_name} - {text}")
-                # Aplicar tamaño si es encabezado
-                if element_name in [f"h{i}" for i in range(1, 7)]:
-                    if element_name == "h1":
-                        width_size, height_size = 8, 8
-                    elif element_name == "h2":
-                        width_size, height_size = 7, 7
-                    elif element_name == "h3":
-                        width_size, height_size = 6, 6
-                    elif element_name == "h4":
-                        width_size, height_size = 5, 5
-                    elif element_name == "h5":
-                        width_size, height_size = 4, 4
-                    elif element_name == "h6":
-                        width_size, height_size = 3, 3
+                # Otros elementos centrados
+                text = child.get_text(strip=True)
+                if text:
+                    # print(f"Texto centrado: {text}")
+                    if ctx.raw_format:
+                        emit_centered(p, ctx.state, text)
                     else:
-                        width_size, height_size = 1, 1
-                    
-                    try:
-                        p.set(align="center", bold=True)
-                        if width_size > 1 or height_size > 1:
-                            # size_param = ((width_size - 1) << 4) | (height_size - 1)
-                            size_param = width_size
-                            p._raw(bytes([0x1B, 0x21, size_param]))
-                        p.text(text)
-                        p.text("\n")  # Usar salto simple
-                        p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                        p.set(align="left", bold=False)
-                    except:
                         padding = max(0, (char_width - len(text)) // 2)
-                        p.set(bold=True)
-                        if width_size > 1 or height_size > 1:
-                            # size_param = ((width_size - 1) << 4) | (height_size - 1)
-                            size_param = width_size
-                            p._raw(bytes([0x1B, 0x21, size_param]))
                         p.text(" " * padding + text + "\n")
-                        p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                        p.set(bold=False)
+        elif hasattr(child, 'strip'):
+            # Es texto plano
+            text = child.strip()
+            if text:
+                # print(f"Texto plano centrado: {text}")
+                if ctx.raw_format:
+                    emit_centered(p, ctx.state, text)
                 else:
-                    try:
-                        p.set(align="center")
-                        p.text(text)
-                        p.text("\n")  # Usar salto simple
-                        p.set(align="left")
-                    except:
-                        padding = max(0, (char_width - len(text)) // 2)
-                        p.text(" " * padding + text + "\n")
+                    padding = max(0, (char_width - len(text)) // 2)
+                    p.text(" " * padding + text + "\n")
+
+
+def _handle_centered_style(element, p, ctx):
+    """Elementos con estilo text-align center"""
+    char_width = ctx.char_width
+    text = element.get_text(strip=True)
+    if text:
+        # print(f"Elemento con text-align center: {element.name} - {text}")
+        # Aplicar tamaño si es encabezado
+        if element.name in HEADING_SIZES:
+            _emit_heading(p, ctx, text, HEADING_SIZES[element.name])
+        else:
+            if ctx.raw_format:
+                emit_centered(p, ctx.state, text)
+            else:
+                padding = max(0, (char_width - len(text)) // 2)
+                p.text(" " * padding + text + "\n")
 
-        # Negrita, cursiva, subrayado (solo si no están dentro de otros elementos procesados)
-        elif element_name == "b":
-            text = element.get_text(strip=True)
-            if text:
-                p.set(bold=True)
-                p.text(text + "\n")
-                p.set(bold=False)
 
-        elif element_name == "i":
-            text = element.get_text(strip=True)
-            if text:
-                p.set(italic=True)
-                p.text(text + "\n")
-                p.set(italic=False)
+def _handle_bold(element, p, ctx):
+    """Negrita (solo si no está dentro de otros elementos procesados)"""
+    text = element.get_text(strip=True)
+    if text:
+        _emit_style(p, ctx.state, bold=True)
+        p.text(text + "\n")
+        _emit_style(p, ctx.state, bold=False)
 
-        elif element_name == "u":
-            text = element.get_text(strip=True)
-            if text:
-                p.set(underline=1)
-                p.text(text + "\n")
-                p.set(underline=0)
-        # Imágenes Base64
-        elif element_name == "img":
-            # print(f"DEBUG: Procesando elemento <img>")
-            src = element.get("src", "")
-            # print(f"DEBUG: src = {src[:100]}..." if len(src) > 100 else f"DEBUG: src = {src}")
-            if "base64" in src:
-                # print("DEBUG: Imagen base64 detectada, procesando...")
-                try:
-                    img_b64 = src.split(",")[1]
-                    # print(f"DEBUG: Base64 extraído, longitud: {len(img_b64)}")
-                    image_data = base64.b64decode(img_b64)
-                    # print(f"DEBUG: Datos decodificados, tamaño: {len(image_data)} bytes")
-                    image = Image.open(BytesIO(image_data))
-                    # print(f"DEBUG: Imagen PIL cargada: {image.size[0]}x{image.size[1]}, modo: {image.mode}")
-                except Exception as e:
-                    # print(f"ERROR: Error procesando imagen base64: {e}")
-                    return
 
-                # Calcular ancho máximo en píxeles para el papel
-                max_width_px = 576 if paper_size == "80mm" else 384  # 80mm ≈ 576px, 58mm ≈ 384px
-                # print(f"DEBUG: Ancho máximo para papel {paper_size}: {max_width_px}px")
-                
-                # Obtener dimensiones desde atributos width/height o style
-                width = None
-                height = None
-                # Atributos directos
-                if element.has_attr("width"):
-                    try:
-                        width = int(element["width"])
-                    except:
-                        pass
-                if element.has_attr("height"):
-                    try:
-                        height = int(element["height"])
-                    except:
-                        pass
-                # Buscar en style
-                if element.has_attr("style"):
-                    style = element["style"]
-                    import re
-                    width_match = re.search(r"width\s*:\s*(\d+)px", style)
-                    height_match = re.search(r"height\s*:\s*(\d+)px", style)
-                    if width_match:
-                        width = int(width_match.group(1))
-                    if height_match:
-                        height = int(height_match.group(1))
-
-                # Redimensionar según el tamaño de papel
-                orig_w, orig_h = image.size
-                if width or height:
-                    new_w = width if width else orig_w
-                    new_h = height if height else orig_h
-                else:
-                    # Auto-ajustar al ancho del papel si no se especifica
-                    if orig_w > max_width_px:
-                        new_w = max_width_px
-                        new_h = int((max_width_px * orig_h) / orig_w)
-                    else:
-                        new_w = orig_w
-                        new_h = orig_h
-                
-                # Asegurar que no exceda el ancho máximo
-                if new_w > max_width_px:
-                    new_h = int((max_width_px * new_h) / new_w)
-                    new_w = max_width_px
-                
-                # print(f"DEBUG: Redimensionando imagen a {new_w}x{new_h}")
-                image = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                # print("DEBUG: Enviando imagen a impresora...")
-                try:
-                    p.image(image)
-                    # print("DEBUG: Imagen enviada exitosamente")
-                    p.text("\n")
-                except Exception as e:
-                    print(f"ERROR: Error enviando imagen a impresora: {e}")
-            elif element.get("data-type") == "qr":
-                data = element.get("data-value", "")
-                if data:
-                    qr_size = 15 if paper_size == "80mm" else 12  # QR más grande según papel
-                    p.qr(data, size=qr_size)
-                    p.text("\n")
-
-        # Código de barras
-        elif element_name == "barcode":
-            code = element.get_text(strip=True)
-            barcode_type = element.get("type", "CODE128")
-            barcode_width = 2 if paper_size == "80mm" else 1  # Ajustar ancho según papel
-            p.barcode(code, barcode_type, width=barcode_width, height=80, pos="BELOW", font="A")
-            p.text("\n")
+def _handle_italic(element, p, ctx):
+    """Cursiva"""
+    text = element.get_text(strip=True)
+    if text:
+        p.set(italic=True)
+        p.text(text + "\n")
+        p.set(italic=False)
 
-        # Tablas
-        elif element_name == "table":
-            # Usar ancho específico para tablas
-            table_width = get_char_width(paper_size, font_size, 'table')
-            # print(f"Procesando tabla con ancho {table_width} caracteres")
-            print(f"{paper_size} - Ancho tabla: {table_width} caracteres")
-
-            for tr in element.find_all("tr"):
-                cells = tr.find_all(["td", "th"])
-                if not cells:
-                    continue
-                
-                # Verificar si esta fila tiene encabezados (th)
-                has_headers = any(cell.name == "th" for cell in cells)
-                
-                # Verificar si alguna celda contiene un <hr>
-                has_hr = any(cell.find("hr") is not None for cell in cells)
-                
-                if has_hr:
-                    # Si la fila contiene un <hr>, crear una línea horizontal completa
-                    # Usar el mismo ancho que la tabla para consistencia
-                    hr_width = int(get_char_width(paper_size, font_size, 'wide'))
-                    
-                    # Buscar el primer HR para determinar el estilo
-                    hr_element = None
-                    for cell in cells:
-                        hr_found = cell.find("hr")
-                        if hr_found:
-                            hr_element = hr_found
-                            break
-                    
-                    # Determinar el carácter de línea
-                    line_char = "-"  # Por defecto
-                    if hr_element:
-                        line_style = hr_element.get('style', '').lower() if hr_element.has_attr('style') else ''
-                        line_class = hr_element.get('class', []) if hr_element.has_attr('class') else []
-                        
-                        if 'border-style:double' in line_style or 'double' in line_class:
-                            line_char = "="
-                        elif 'border-style:dotted' in line_style or 'dotted' in line_class:
-                            line_char = "-"
-                        elif 'border-style:dashed' in line_style or 'dashed' in line_class:
-                            line_char = "-"
-                        elif 'solid' in line_class or 'thick' in line_class:
-                            line_char = "#"
-                    
-                    # Crear la línea horizontal
-                    horizontal_line = line_char * hr_width
-                    # print(f"HR en tabla: {hr_width} caracteres con '{line_char}'")
-                    
-                    # Imprimir la línea horizontal
-                    try:
-                        p.set(align="center", font=0)  # Usar alineación centrada para la línea horizontal
-                        if paper_size == "58mm":
-                            p.ln(-2)  # Espacio antes de la línea
-                            p._raw(bytes([0x1B, 0x33, 5]))
-                            p.text(horizontal_line)
-                            p.ln()
-                        else:                            
-                            p.ln(-2)  # Espacio antes de la línea
-                            p._raw(bytes([0x1B, 0x33, 5]))
-                            p.block_text(horizontal_line)
-                            p.ln()
-
-                        set_line_spacing(p, line_spacing)
-                        p.set(align="left", font=0)
-                    except:
-                        p.set(align="center", font=0, custom_size=True, width=1, height=1)  # Usar alineación centrada para la línea horizontal
-                        p.text(horizontal_line)
-                        p.ln(1)
-                    
-                    continue  # Saltar el procesamiento normal de la fila
-                
-                # Extraer texto de las celdas
-                cols = [cell.get_text(strip=True).replace("\n", " ") for cell in cells]
-                
-                # Estrategia de ancho dinámico basada en contenido y número de columnas
-                if len(cols) == 1:
-                    # Una sola columna: usar todo el ancho disponible y aplicar estilos
-                    cell = cells[0]
-                    text = cols[0]
-                    
-                    # Analizar estilos de la celda única
-                    import re
-                    cell_align = 'left'  # Por defecto
-                    is_numeric = bool(re.search(r'[\d$€£¥₹.,]+', text))
-                    
-                    # Analizar atributo style
-                    if cell.has_attr('style'):
-                        style = cell.get('style', '').lower()
-                        
-                        # Buscar text-align
-                        if 'text-align:right' in style:
-                            cell_align = 'right'
-                        elif 'text-align:center' in style:
-                            cell_align = 'center'
-                        elif 'text-align:left' in style:
-                            cell_align = 'left'
-                    
-                    # Si no hay estilo específico, inferir alineación del contenido
-                    if cell_align == 'left' and is_numeric:
-                        cell_align = 'right'  # Números a la derecha por defecto
-                    
-                    # Truncar texto si es muy largo
-                    truncated_text = text[:table_width] if len(text) > table_width else text
-                    
-                    # Aplicar alineación según el estilo
-                    if cell_align == 'right':
-                        line = truncated_text.rjust(table_width)
-                    elif cell_align == 'center':
-                        line = truncated_text.center(table_width)
-                    else:  # left o por defecto
-                        line = truncated_text.ljust(table_width)
-                else:
-                    # Múltiples columnas: análisis dinámico de estilos CSS y contenido
-                    cell_styles = []
-                    total_fixed_width = 0
-                    flexible_columns = []
-                    content_lengths = [len(col) for col in cols]  # Longitudes del contenido
-                    
-                    # Asegurar importación de re
-                    import re
-                    
-                    # Analizar estilos de cada celda y contenido
-                    for i, cell in enumerate(cells):
-                        style_info = {
-                            'width_percent': None,
-                            'width_fixed': None,
-                            'align': 'left',  # Por defecto
-                            'index': i,
-                            'content_length': content_lengths[i],
-                            'is_numeric': bool(re.search(r'[\d$€£¥₹.,]+', cols[i]))
-                        }
-                        
-                        # Analizar atributo style
-                        if cell.has_attr('style'):
-                            style = cell.get('style', '').lower()
-                            
-                            # Buscar text-align
-                            if 'text-align:right' in style:
-                                style_info['align'] = 'right'
-                            elif 'text-align:center' in style:
-                                style_info['align'] = 'center'
-                            elif 'text-align:left' in style:
-                                style_info['align'] = 'left'
-                            else:
-                                style_info['align'] = 'left'  # Por defecto
-                            
-                            # Buscar width en porcentaje
-                            import re
-                            width_percent_match = re.search(r'width\s*:\s*(\d+(?:\.\d+)?)%', style)
-                            if width_percent_match:
-                                style_info['width_percent'] = float(width_percent_match.group(1))
-                            
-                            # Buscar width en píxeles, caracteres o unidades
-                            width_px_match = re.search(r'width\s*:\s*(\d+)(?:px|ch|em|%)?', style)
-                            if width_px_match:
-                                # Conversión inteligente: px/8, ch=1, em*14
-                                value = int(width_px_match.group(1))
-                                if 'ch' in style:
-                                    style_info['width_fixed'] = value
-                                elif 'em' in style:
-                                    style_info['width_fixed'] = max(1, int(value * 1.4))
-                                elif '%' in style:
-                                    style_info['width_percent'] = float(value)
-                                else:  # px por defecto
-                                    style_info['width_fixed'] = max(1, value // 8)
-                        
-                        # Si no hay estilo específico, inferir alineación del contenido
-                        # if style_info['align'] == 'left' and style_info['is_numeric']:
-                        #     style_info['align'] = 'right'  # Números a la derecha por defecto
-                        
-                        cell_styles.append(style_info)
-                        
-                        # Acumular anchos fijos
-                        if style_info['width_fixed']:
-                            total_fixed_width += style_info['width_fixed']
-                        elif not style_info['width_percent']:
-                            flexible_columns.append(i)
-                    
-                    # Calcular anchos de columnas con distribución inteligente
-                    col_widths = []
-                    
-                    # Calcular anchos basados en porcentajes
-                    for style in cell_styles:
-                        if style['width_percent']:
-                            width = max(1, int(table_width * style['width_percent'] / 100))
-                            col_widths.append(width)
-                        elif style['width_fixed']:
-                            col_widths.append(style['width_fixed'])
-                        else:
-                            col_widths.append(0)  # Se calculará después
-                    
-                    # Distribuir espacio restante entre columnas flexibles
-                    remaining_for_flexible = table_width - sum(col_widths)
-                    if flexible_columns and remaining_for_flexible > 0:
-                        # Distribución basada en contenido para columnas flexibles
-                        total_content_length = sum(cell_styles[i]['content_length'] for i in flexible_columns)
-                        
-                        if total_content_length > 0:
-                            # Distribución proporcional al contenido
-                            for col_idx in flexible_columns:
-                                content_ratio = cell_styles[col_idx]['content_length'] / total_content_length
-                                col_widths[col_idx] = max(1, int(remaining_for_flexible * content_ratio))
-                        else:
-                            # Distribución uniforme si no hay contenido
-                            flex_width = max(1, remaining_for_flexible // len(flexible_columns))
-                            extra_width = remaining_for_flexible % len(flexible_columns)
-                            
-                            for i, col_idx in enumerate(flexible_columns):
-                                col_widths[col_idx] = flex_width + (1 if i < extra_width else 0)
-                    
-                    # Asegurar que la suma no exceda el ancho total
-                    total_width = sum(col_widths)
-                    if total_width > table_width:
-                        # Reducir proporcionalmente
-                        factor = table_width / total_width
-                        col_widths = [max(1, int(w * factor)) for w in col_widths]
-                        # Ajustar diferencia restante
-                        diff = table_width - sum(col_widths)
-                        for i in range(min(abs(diff), len(col_widths))):
-                            col_widths[i] += 1 if diff > 0 else -1
-                    
-                    # Formatear columnas con estilos aplicados
-                    formatted_cols = []
-                    for i, (col, width, style) in enumerate(zip(cols, col_widths, cell_styles)):
-                        # Truncar texto si es muy largo
-                        truncated_text = col[:width] if len(col) > width else col
-                        
-                        # Aplicar alineación según el estilo
-                        if style['align'] == 'right':
-                            formatted_col = truncated_text.rjust(width)
-                        elif style['align'] == 'center':
-                            formatted_col = truncated_text.center(width)
-                        else:  # left o por defecto
-                            formatted_col = truncated_text.ljust(width)
-                        
-                        formatted_cols.append(formatted_col)
-                        
-                        # Debug: mostrar información de estilo
-                        # if style['width_percent'] or style['width_fixed'] or style['align'] != 'left':
-                            # print(f"  Columna {i}: '{col[:20]}...' -> ancho={width}, align={style['align']}, width_style={style['width_percent'] or style['width_fixed']}")
-                    
-                    line = "".join(formatted_cols)
-                
-                # Asegurar que la línea use exactamente el ancho de la tabla
-                if len(line) > table_width:
-                    line = line[:table_width]
-                elif len(line) < table_width:
-                    line = line.ljust(table_width)
-                
-                # Aplicar formato según si tiene encabezados (th)
-                if has_headers:
-                    # print(f"Fila de tabla con encabezados (th): {line}")
-                    p.set(bold=True, align="center")  # Negrita para encabezados
-                else:
-                    # print(f"Fila de tabla normal (td): {line}")
-                    p.set(bold=False)  # Sin negrita para celdas normales
-
-                # Imprimir la línea de la tabla
-                if paper_size == "58mm":
-                    p._raw(bytes([0x1B, 0x21, 5]))  # Tamaño ligeramente más grande para tablas              
-                    p.block_text(line)
-                    p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                    p.set(bold=False)  # Reset negrita
-                    p.ln(1)
-                else:
-                    p._raw(bytes([0x1B, 0x21, 5]))  # Tamaño ligeramente más grande para tablas              
-                    p.text(line)
-                    p._raw(bytes([0x1B, 0x21, 0x00]))  # Reset tamaño
-                    p.set(bold=False)  # Reset negrita
-                    p.ln(1)
-
-        # Línea horizontal <hr>
-        elif element_name == "hr":
-            # Obtener ancho completo del papel para la línea horizontal
-            hr_width = int(get_char_width(paper_size, font_size, 'wide'))
-            
-            # Detectar el tipo de línea desde atributos o estilos
-            line_char = "-"  # Por defecto
-            line_style = element.get('style', '').lower() if element.has_attr('style') else ''
-            line_class = element.get('class', []) if element.has_attr('class') else []
-            
-            # Determinar el carácter de línea según estilos o clases
-            if 'border-style:double' in line_style or 'double' in line_class:
-                line_char = "="
-            elif 'border-style:dotted' in line_style or 'dotted' in line_class:
-                line_char = "-"
-            elif 'border-style:dashed' in line_style or 'dashed' in line_class:
-                line_char = "-"
-            elif 'solid' in line_class or 'thick' in line_class:
-                line_char = "#"  # Usar # para líneas sólidas (compatible ASCII)
-            
-            # Crear la línea horizontal
-            horizontal_line = line_char * hr_width
-            
-            # print(f"Línea horizontal: {hr_width} caracteres con '{line_char}'")
-            
-            # Imprimir la línea
+
+def _handle_underline(element, p, ctx):
+    """Subrayado"""
+    text = element.get_text(strip=True)
+    if text:
+        _emit_style(p, ctx.state, underline=1)
+        p.text(text + "\n")
+        _emit_style(p, ctx.state, underline=0)
+
+
+def style_dimensions(style):
+    """(width, height) en px de un style; gana la primera aparición de cada uno, como re.search"""
+    dims = {}
+    for name, value in _STYLE_WH.findall(style):
+        dims.setdefault(name, int(value))
+    return dims.get("width"), dims.get("height")
+
+
+# Tabla para point(): deja en 0 los píxeles que ya son blanco o negro puros
+_NOT_BILEVEL_LUT = [0] + [255] * 254 + [0]
+
+
+def to_thermal_bitmap(image):
+    """Convierte una imagen a 1 bit sobre fondo blanco con tramado Floyd-Steinberg"""
+    if image.mode in ("RGBA", "LA", "P"):
+        # Quitar transparencia pegando sobre blanco, igual que EscposImage
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        image = background
+    image = image.convert("L")
+    # Logos ya en blanco y negro: el umbral da los mismos píxeles que el tramado, mucho más rápido
+    if image.point(_NOT_BILEVEL_LUT).getbbox() is None:
+        return image.convert("1", dither=Image.Dither.NONE)
+    return image.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+
+
+# Tamaño máximo de cada bloque GS v 0, el mismo fragment_height que usa Escpos.image()
+RASTER_FRAGMENT_HEIGHT = 960
+
+
+def print_raster_image(p, image):
+    """
+    Envía una imagen con GS v 0 (alta densidad), con los mismos bytes que
+    p.image(image, impl="bitImageRaster"). Si la imagen ya es de 1 bit se
+    empaqueta directamente, sin la conversión RGBA -> L -> 1 de EscposImage.
+    """
+    if image.mode != "1":
+        p.image(image, impl="bitImageRaster")
+        return
+    try:
+        max_width = int(p.profile.profile_data["media"]["width"]["pixels"])
+        if image.width > max_width:
+            raise ImageWidthError(f"{image.width} > {max_width}")
+    except (KeyError, ValueError):
+        # Ancho del perfil desconocido: se imprime igual, como python-escpos
+        pass
+    width_bytes = (image.width + 7) >> 3
+    for upper in range(0, image.height, RASTER_FRAGMENT_HEIGHT):
+        fragment = image.crop((0, upper, image.width, min(upper + RASTER_FRAGMENT_HEIGHT, image.height)))
+        # En ESC/POS el bit 1 es un punto negro: al revés que en el modo 1 de PIL
+        p._raw(
+            b"\x1dv0\x00"
+            + width_bytes.to_bytes(2, "little")
+            + fragment.height.to_bytes(2, "little")
+            + ImageChops.invert(fragment).tobytes()
+        )
+
+
+# Caché LRU de imágenes base64 ya listas para imprimir (logos que se repiten entre tickets)
+IMAGE_CACHE_SIZE = 64
+_image_cache = OrderedDict()
+_image_cache_lock = threading.Lock()
+
+
+# Formato de PIL según el tipo MIME del data URI, para que Image.open no pruebe cada plugin
+_MIME_FORMATS = {
+    "image/png": "PNG", "image/jpeg": "JPEG", "image/jpg": "JPEG",
+    "image/gif": "GIF", "image/bmp": "BMP", "image/webp": "WEBP",
+}
+
+
+def image_format_hint(src):
+    """Formato de PIL declarado en un data URI (data:image/png;base64,...) o None"""
+    if not src.startswith("data:"):
+        return None
+    return _MIME_FORMATS.get(src[5:src.find(";")].strip().lower())
+
+
+def open_image_bytes(data, fmt=None):
+    """Image.open sobre bytes, probando primero solo el formato indicado"""
+    if fmt:
+        try:
+            return Image.open(BytesIO(data), formats=(fmt,))
+        except UnidentifiedImageError:
+            # El MIME no coincidía con el contenido: probar todos los formatos
+            pass
+    return Image.open(BytesIO(data))
+
+
+def load_thermal_image(img_b64, width, height, max_width_px, fmt=None):
+    """Decodifica, redimensiona y trama a 1 bit una imagen base64; una imagen repetida sale de la caché"""
+    # Codificar una sola vez: los mismos bytes sirven para la clave y para decodificar
+    img_b64 = img_b64.encode("ascii")
+    key = (hashlib.sha1(img_b64).digest(), width, height, max_width_px)
+    with _image_cache_lock:
+        image = _image_cache.get(key)
+        if image is not None:
+            _image_cache.move_to_end(key)
+            return image
+
+    image = open_image_bytes(binascii.a2b_base64(img_b64), fmt)
+
+    # Redimensionar según el tamaño de papel
+    orig_w, orig_h = image.size
+    if width or height:
+        new_w = width if width else orig_w
+        new_h = height if height else orig_h
+    else:
+        # Auto-ajustar al ancho del papel si no se especifica
+        if orig_w > max_width_px:
+            new_w = max_width_px
+            new_h = int((max_width_px * orig_h) / orig_w)
+        else:
+            new_w = orig_w
+            new_h = orig_h
+
+    # Asegurar que no exceda el ancho máximo
+    if new_w > max_width_px:
+        new_h = int((max_width_px * new_h) / new_w)
+        new_w = max_width_px
+
+    # En JPEG, draft() hace que libjpeg decodifique ya reducido (escala DCT)
+    # a un tamaño no menor que el destino; en otros formatos no hace nada
+    image.draft(None, (new_w, new_h))
+    # BILINEAR es indistinguible de LANCZOS en una impresora térmica de 1 bit
+    image = image.resize((new_w, new_h), Image.Resampling.BILINEAR)
+    # Tramar a 1 bit aquí (en C) para que python-escpos no tenga que hacerlo
+    image = to_thermal_bitmap(image)
+
+    with _image_cache_lock:
+        _image_cache[key] = image
+        if len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+    return image
+
+
+def _handle_image(element, p, ctx):
+    """Imágenes Base64 y códigos QR declarados como <img data-type="qr">"""
+    paper_size = ctx.paper_size
+    src = element.get("src", "")
+    # print(f"DEBUG: src = {src[:100]}..." if len(src) > 100 else f"DEBUG: src = {src}")
+    if "base64" in src:
+        # print("DEBUG: Imagen base64 detectada, procesando...")
+        # Calcular ancho máximo en píxeles para el papel
+        max_width_px = 576 if paper_size == "80mm" else 384  # 80mm ≈ 576px, 58mm ≈ 384px
+        # print(f"DEBUG: Ancho máximo para papel {paper_size}: {max_width_px}px")
+
+        # Obtener dimensiones desde atributos width/height o style
+        width = None
+        height = None
+        # Atributos directos
+        if element.has_attr("width"):
+            try:
+                width = int(element["width"])
+            except:
+                pass
+        if element.has_attr("height"):
             try:
-                p.set(align="center", font=0)  # Usar alineación centrada para la línea horizontal
-                p.ln(-2)  # Espacio antes de la línea
-                p._raw(bytes([0x1B, 0x33, 5]))
-                p.text(horizontal_line)
-                p.ln()
-                set_line_spacing(p, line_spacing)
+                height = int(element["height"])
             except:
-                # Fallback simple
-                p.set(align="center", font=0, custom_size=True, width=1, height=1)  # Usar alineación centrada para la línea horizontal
-                p.text(horizontal_line + "\n")
-
-        # Código QR directo (etiqueta personalizada)
-        elif element_name == "qr":
-            data = element.get_text(strip=True)
-            qr_size = 8 if paper_size == "80mm" else 12  # QR más grande según papel
+                pass
+        # Buscar en style
+        if element.has_attr("style"):
+            style_width, style_height = style_dimensions(element["style"])
+            if style_width is not None:
+                width = style_width
+            if style_height is not None:
+                height = style_height
+
+        try:
+            image = load_thermal_image(src[src.index(",") + 1:], width, height, max_width_px, image_format_hint(src))
+        except Exception as e:
+            # print(f"ERROR: Error procesando imagen base64: {e}")
+            return
+
+        # print("DEBUG: Enviando imagen a impresora...")
+        try:
+            print_raster_image(p, image)
+            # print("DEBUG: Imagen enviada exitosamente")
+            p.text("\n")
+        except Exception as e:
+            print(f"ERROR: Error enviando imagen a impresora: {e}")
+    elif element.get("data-type") == "qr":
+        data = element.get("data-value", "")
+        if data:
+            qr_size = 15 if paper_size == "80mm" else 12  # QR más grande según papel
             p.qr(data, size=qr_size)
             p.text("\n")
 
-        # Elementos contenedores: procesar hijos recursivamente
-        elif element_name in ["div", "section", "article", "main", "header", "footer"]:
-            # print(f"DEBUG: Procesando contenedor {element_name}, hijos: {[child.name for child in element.children if hasattr(child, 'name') and child.name]}")
-            for child in element.children:
-                if hasattr(child, 'name') and child.name:
-                    process_element(child)
 
-        # Para cualquier otro elemento, procesar recursivamente sus hijos
+def _handle_barcode(element, p, ctx):
+    """Código de barras"""
+    paper_size = ctx.paper_size
+    code = element.get_text(strip=True)
+    barcode_type = element.get("type", "CODE128")
+    barcode_width = 2 if paper_size == "80mm" else 1  # Ajustar ancho según papel
+    p.barcode(code, barcode_type, width=barcode_width, height=80, pos="BELOW", font="A")
+    p.text("\n")
+
+
+def _handle_table(element, p, ctx):
+    """Tablas"""
+    paper_size, font_size = ctx.paper_size, ctx.font_size
+    table_width = get_char_width(paper_size, font_size, 'table')
+    # print(f"Procesando tabla con ancho {table_width} caracteres")
+    print(f"{paper_size} - Ancho tabla: {table_width} caracteres")
+    # Ancho de las filas con <hr>, igual para todo el ticket
+    hr_width = ctx.hr_width
+
+    # Búfer reutilizado por todas las filas; arranca con la página de códigos de p
+    buf = Dummy()
+    buf.magic.encoding = p.magic.encoding
+    rows = [render_row(tr, buf, ctx, table_width, hr_width) for tr in element.find_all("tr")]
+    p._raw(b"".join(rows))
+    p.magic.encoding = buf.magic.encoding
+
+
+# Conversión de anchos CSS a (width_percent, width_fixed): px/8, ch=1, em*1.4 (sin unidad = px)
+_WIDTH_UNITS = {
+    '%': lambda v: (v, None),
+    'px': lambda v: (None, max(1, int(v) // 8)),
+    'ch': lambda v: (None, int(v)),
+    'em': lambda v: (None, max(1, int(v * 1.4))),
+}
+
+
+def _parse_style(style):
+    """Convierte un atributo style en {propiedad: valor} en una sola pasada"""
+    return {
+        k.strip(): v.strip()
+        for k, v in (d.split(':', 1) for d in style.lower().split(';') if ':' in d)
+    }
+
+
+def _css_align(decls):
+    """Alineación de una celda: 'right', 'center' o 'left' (por defecto)"""
+    align = decls.get('text-align', 'left')
+    return align if align in ('right', 'center') else 'left'
+
+
+def _css_width(value):
+    """Devuelve (width_percent, width_fixed) a partir del valor CSS de width"""
+    match = _RE_WIDTH_VAL.match(value)
+    if not match:
+        return None, None
+    number, unit = match.groups()
+    return _WIDTH_UNITS[unit or 'px'](float(number))
+
+
+def _apportion(widths, total):
+    """
+    Escala los anchos para que sumen exactamente total (método del mayor resto).
+    Cada columna conserva al menos 1 carácter.
+    """
+    factor = total / sum(widths)
+    exact = [w * factor for w in widths]
+    result = [max(1, int(e)) for e in exact]
+    remainder = total - sum(result)
+    if remainder > 0:
+        # Repartir lo que falta entre las columnas con mayor parte decimal
+        order = sorted(range(len(result)), key=lambda i: exact[i] - result[i], reverse=True)
+        for i in order[:remainder]:
+            result[i] += 1
+    elif remainder < 0:
+        # El mínimo de 1 carácter se pasó del total: quitar a las columnas más anchas
+        order = sorted(range(len(result)), key=lambda i: result[i], reverse=True)
+        for i in order[:-remainder]:
+            if result[i] > 1:
+                result[i] -= 1
+    return result
+
+
+# Relleno de una celda según su alineación (ljust para left o cualquier otro valor)
+_CELL_PAD = {'right': str.rjust, 'center': str.center}
+
+
+def _looks_numeric(text):
+    """True si el texto contiene dígitos o símbolos de moneda/decimales"""
+    return any(c in _CURRENCY_CHARS for c in text)
+
+
+@lru_cache(maxsize=256)
+def _style_to_info(style):
+    """
+    (align, width_percent, width_fixed) de una celda a partir de su atributo style.
+    Las celdas de un ticket repiten casi siempre los mismos estilos, así que se cachea.
+    """
+    decls = _parse_style(style)
+    return (_css_align(decls),) + _css_width(decls.get('width', ''))
+
+
+def render_row(tr, buf, ctx, table_width, hr_width):
+    """
+    Renderiza una fila <tr> y devuelve sus bytes ESC/POS.
+    buf es un búfer Dummy que se vacía al empezar; la fila no escribe en la impresora.
+    """
+    buf.clear()
+    paper_size, line_spacing = ctx.paper_size, ctx.line_spacing
+    cells = tr.find_all(["td", "th"])
+    if not cells:
+        return b""
+
+    # Buscar el primer <hr> de la fila en un solo recorrido; sirve tanto para
+    # detectar la fila separadora como para determinar el estilo de la línea
+    hr_element = None
+    for cell in cells:
+        hr_element = cell.find("hr")
+        if hr_element is not None:
+            break
+
+    if hr_element is not None:
+        # Si la fila contiene un <hr>, crear una línea horizontal completa
+        line_char = get_hr_char(hr_element)
+
+        # Crear la línea horizontal
+        horizontal_line = _hr_line(line_char, hr_width)
+        # print(f"HR en tabla: {hr_width} caracteres con '{line_char}'")
+
+        # Imprimir la línea horizontal
+        try:
+            buf.set(align="center", font=0)  # Usar alineación centrada para la línea horizontal
+            if paper_size == "58mm":
+                buf.ln(-2)  # Espacio antes de la línea
+                buf._raw(ESC_LINE_SPACING_5)
+                buf.text(horizontal_line)
+                buf.ln()
+            else:                            
+                buf.ln(-2)  # Espacio antes de la línea
+                buf._raw(ESC_LINE_SPACING_5)
+                buf.block_text(horizontal_line)
+                buf.ln()
+
+            set_line_spacing(buf, line_spacing)
+            buf.set(align="left", font=0)
+        except:
+            buf.set(align="center", font=0, custom_size=True, width=1, height=1)  # Usar alineación centrada para la línea horizontal
+            buf.text(horizontal_line)
+            buf.ln(1)
+
+        return buf.output  # Saltar el procesamiento normal de la fila
+
+    # Verificar si esta fila tiene encabezados (th)
+    has_headers = any(cell.name == "th" for cell in cells)
+
+    # Extraer texto de las celdas
+    cols = [cell.get_text(strip=True).replace("\n", " ") for cell in cells]
+
+    # Estrategia de ancho dinámico basada en contenido y número de columnas
+    if len(cols) == 1:
+        # Una sola columna: usar todo el ancho disponible y aplicar estilos
+        cell = cells[0]
+        text = cols[0]
+
+        # Analizar estilos de la celda única
+        cell_align = 'left'  # Por defecto
+
+        # Analizar atributo style
+        if cell.has_attr('style'):
+            cell_align = _style_to_info(cell.get('style', ''))[0]
+
+        # Si no hay estilo específico, inferir alineación del contenido
+        if cell_align == 'left' and _looks_numeric(text):
+            cell_align = 'right'  # Números a la derecha por defecto
+
+        # Truncar texto si es muy largo y aplicar la alineación según el estilo
+        line = _CELL_PAD.get(cell_align, str.ljust)(text[:table_width], table_width)
+    else:
+        # Múltiples columnas: análisis dinámico de estilos CSS y contenido
+        # Listas paralelas indexadas por columna en lugar de un dict por celda
+        aligns = []
+        width_pcts = []
+        width_fixeds = []
+        total_fixed_width = 0
+        flexible_columns = []
+        content_lengths = [len(col) for col in cols]  # Longitudes del contenido
+
+        # Analizar estilos de cada celda (una sola pasada por declaración)
+        for i, cell in enumerate(cells):
+            if cell.has_attr('style'):
+                align, width_pct, width_fixed = _style_to_info(cell.get('style', ''))
+            else:
+                align, width_pct, width_fixed = 'left', None, None
+            aligns.append(align)
+            width_pcts.append(width_pct)
+            width_fixeds.append(width_fixed)
+
+            # Acumular anchos fijos
+            if width_fixed:
+                total_fixed_width += width_fixed
+            elif not width_pct:
+                flexible_columns.append(i)
+
+        # Calcular anchos de columnas con distribución inteligente
+        col_widths = []
+
+        # Calcular anchos basados en porcentajes
+        for width_pct, width_fixed in zip(width_pcts, width_fixeds):
+            if width_pct:
+                col_widths.append(max(1, int(table_width * width_pct / 100)))
+            elif width_fixed:
+                col_widths.append(width_fixed)
+            else:
+                col_widths.append(0)  # Se calculará después
+
+        # Distribuir espacio restante entre columnas flexibles
+        remaining_for_flexible = table_width - sum(col_widths)
+        if flexible_columns and remaining_for_flexible > 0:
+            # Distribución basada en contenido para columnas flexibles
+            flex_lengths = [content_lengths[i] for i in flexible_columns]
+            total_content_length = sum(flex_lengths)
+
+            if total_content_length > 0:
+                # Distribución proporcional al contenido (aritmética entera, sin redondeos de float)
+                for col_idx, length in zip(flexible_columns, flex_lengths):
+                    col_widths[col_idx] = max(1, remaining_for_flexible * length // total_content_length)
+            else:
+                # Distribución uniforme si no hay contenido
+                flex_width = max(1, remaining_for_flexible // len(flexible_columns))
+                extra_width = remaining_for_flexible % len(flexible_columns)
+
+                for i, col_idx in enumerate(flexible_columns):
+                    col_widths[col_idx] = flex_width + (1 if i < extra_width else 0)
+
+        # Asegurar que la suma no exceda el ancho total
+        total_width = sum(col_widths)
+        if total_width > table_width:
+            # Reducir proporcionalmente
+            col_widths = _apportion(col_widths, table_width)
+
+        # Formatear columnas con estilos aplicados
+        formatted_cols = []
+        for i, (col, width, align) in enumerate(zip(cols, col_widths, aligns)):
+            # Truncar texto si es muy largo y aplicar la alineación según el estilo
+            formatted_cols.append(_CELL_PAD.get(align, str.ljust)(col[:width], width))
+
+            # Debug: mostrar información de estilo
+            # if width_pcts[i] or width_fixeds[i] or align != 'left':
+                # print(f"  Columna {i}: '{col[:20]}...' -> ancho={width}, align={align}, width_style={width_pcts[i] or width_fixeds[i]}")
+
+        line = "".join(formatted_cols)
+
+    # Asegurar que la línea use exactamente el ancho de la tabla
+    line = line[:table_width].ljust(table_width)
+
+    # Fila en blanco: basta con el salto de línea, sin enviar espacios ni cambios de tamaño
+    if not line.strip():
+        buf.ln(1)
+        return buf.output
+
+    # Fila ASCII en 80mm: estilo, tamaño y texto en una sola escritura
+    # (ASCII es igual en todas las páginas de códigos; 58mm necesita el ajuste de block_text)
+    if paper_size != "58mm" and line.isascii():
+        style = ESC_BOLD_ON + ALIGN_CMD["center"] if has_headers else ESC_BOLD_OFF
+        buf._raw(style + ESC_SIZE_LARGE + line.encode("ascii") + ESC_SIZE_RESET + ESC_BOLD_OFF + b"\n")
+        return buf.output
+
+    # Aplicar formato según si tiene encabezados (th)
+    if has_headers:
+        # print(f"Fila de tabla con encabezados (th): {line}")
+        buf.set(bold=True, align="center")  # Negrita para encabezados
+    else:
+        # print(f"Fila de tabla normal (td): {line}")
+        buf.set(bold=False)  # Sin negrita para celdas normales
+
+    # Imprimir la línea de la tabla
+    if paper_size == "58mm":
+        buf._raw(ESC_SIZE_LARGE)  # Tamaño ligeramente más grande para tablas              
+        buf.block_text(line)
+        buf._raw(ESC_SIZE_RESET)  # Reset tamaño
+        buf.set(bold=False)  # Reset negrita
+        buf.ln(1)
+    else:
+        buf._raw(ESC_SIZE_LARGE)  # Tamaño ligeramente más grande para tablas              
+        buf.text(line)
+        buf._raw(ESC_SIZE_RESET)  # Reset tamaño
+        buf.set(bold=False)  # Reset negrita
+        buf.ln(1)
+
+    return buf.output
+
+
+@lru_cache(maxsize=16)
+def _hr_line(line_char, width):
+    """Línea horizontal de width caracteres; los separadores se repiten mucho en un ticket"""
+    return line_char * width
+
+
+def get_hr_char(hr_element):
+    """Retorna el carácter con el que se dibuja un <hr> según su estilo o clase"""
+    line_style = hr_element.get('style', '').lower()
+    line_class = hr_element.get('class', [])
+
+    if _HR_DOUBLE_RE.search(line_style) or 'double' in line_class:
+        return "="
+    elif _HR_DOTTED_RE.search(line_style) or 'dotted' in line_class:
+        return "-"
+    elif _HR_DASHED_RE.search(line_style) or 'dashed' in line_class:
+        return "-"
+    elif 'solid' in line_class or 'thick' in line_class:
+        return "#"  # Usar # para líneas sólidas (compatible ASCII)
+    return "-"  # Por defecto
+
+
+def _handle_hr(element, p, ctx):
+    """Línea horizontal <hr>"""
+    line_spacing = ctx.line_spacing
+    hr_width = ctx.hr_width
+
+    # Detectar el tipo de línea desde atributos o estilos
+    line_char = get_hr_char(element)
+
+    # Crear la línea horizontal
+    horizontal_line = _hr_line(line_char, hr_width)
+
+    # print(f"Línea horizontal: {hr_width} caracteres con '{line_char}'")
+
+    # Imprimir la línea
+    try:
+        p.set(align="center", font=0)  # Usar alineación centrada para la línea horizontal
+        p.ln(-2)  # Espacio antes de la línea
+        p._raw(ESC_LINE_SPACING_5)
+        p.text(horizontal_line)
+        p.ln()
+        set_line_spacing(p, line_spacing)
+    except:
+        # Fallback simple
+        p.set(align="center", font=0, custom_size=True, width=1, height=1)  # Usar alineación centrada para la línea horizontal
+        p.text(horizontal_line + "\n")
+
+
+def _handle_qr(element, p, ctx):
+    """Código QR directo (etiqueta personalizada)"""
+    paper_size = ctx.paper_size
+    data = element.get_text(strip=True)
+    qr_size = 8 if paper_size == "80mm" else 12  # QR más grande según papel
+    p.qr(data, size=qr_size)
+    p.text("\n")
+
+
+def _handle_container(element, p, ctx):
+    """Elementos contenedores y cualquier otro elemento: procesar sus hijos"""
+    # print(f"DEBUG: Procesando contenedor {element.name}, hijos: {[child.name for child in element.children if hasattr(child, 'name') and child.name]}")
+    _walk(element.children, p, ctx)
+
+
+# Despacho por etiqueta; las no registradas se tratan como contenedores
+ELEMENT_HANDLERS = {
+    **{name: _handle_heading for name in HEADING_SIZES},
+    "p": _handle_paragraph,
+    "center": _handle_center,
+    "b": _handle_bold,
+    "i": _handle_italic,
+    "u": _handle_underline,
+    "img": _handle_image,
+    "barcode": _handle_barcode,
+    "table": _handle_table,
+    "hr": _handle_hr,
+    "qr": _handle_qr,
+}
+
+# Manejadores que emiten formato solo a través de _emit_size/_emit_style
+_STATE_AWARE_HANDLERS = frozenset({
+    _handle_heading, _handle_paragraph, _handle_center, _handle_centered_style,
+    _handle_bold, _handle_underline, _handle_container,
+})
+
+# Etiquetas que conservan su propio formato aunque tengan style="text-align:center"
+_STYLE_CENTER_EXEMPT = frozenset(HEADING_SIZES) | {"p", "center"}
+
+
+def _process_element(element, p, ctx):
+    """Procesa un elemento HTML y sus descendientes evitando duplicaciones"""
+    _walk((element,), p, ctx)
+
+
+def _walk(elements, p, ctx):
+    """
+    Recorre los elementos en orden de documento con una pila explícita en lugar
+    de recursión: los contenedores no imprimen nada, solo apilan sus hijos
+    """
+    stack = [element for element in elements if getattr(element, 'name', None)]
+    stack.reverse()
+    while stack:
+        element = stack.pop()
+        # Ambos parsers (lexbor y BeautifulSoup) ya entregan los nombres de etiqueta en minúsculas
+        element_name = element.name
+        # print(f"DEBUG: Procesando elemento: {element_name}")
+
+        if element_name not in _STYLE_CENTER_EXEMPT and 'text-align:center' in element.get('style', ''):
+            handler = _handle_centered_style
         else:
-            for child in element.children:
-                if hasattr(child, 'name') and child.name:
-                    process_element(child)
+            handler = ELEMENT_HANDLERS.get(element_name, _handle_container)
+
+        if handler is _handle_container:
+            # Apilar los hijos en orden inverso para conservar el orden del documento
+            children = [child for child in element.children if getattr(child, 'name', None)]
+            children.reverse()
+            stack.extend(children)
+            continue
+
+        handler(element, p, ctx)
+        if handler not in _STATE_AWARE_HANDLERS:
+            # El manejador pudo cambiar formato sin pasar por _emit_*; no suponer nada
+            ctx.state.invalidate()
 
-    # Iniciar el procesamiento desde los elementos de nivel superior
-    body = soup.find('body') or soup
-    for element in body.children:
-        if hasattr(element, 'name') and element.name:
-            process_element(element)
 
+class SelectolaxElement:
+    """
+    Envuelve un nodo de selectolax exponiendo la parte de la API de BeautifulSoup
+    que usan los manejadores (name, children, get, has_attr, get_text, find, find_all)
+    """
+    __slots__ = ("node", "name")
+
+    def __init__(self, node):
+        self.node = node
+        self.name = node.tag
+
+    @property
+    def children(self):
+        # Los textos se entregan como str (igual que NavigableString); los comentarios se omiten
+        for child in self.node.iter(include_text=True):
+            if child.tag == "-text":
+                yield child.text(deep=False)
+            elif child.tag != "-comment":
+                yield SelectolaxElement(child)
+
+    def has_attr(self, key):
+        return key in self.node.attributes
+
+    def get(self, key, default=None):
+        attributes = self.node.attributes
+        if key not in attributes:
+            return default
+        value = attributes[key] or ""
+        # BeautifulSoup entrega class como lista
+        return value.split() if key == "class" else value
+
+    def __getitem__(self, key):
+        if key not in self.node.attributes:
+            raise KeyError(key)
+        return self.get(key)
+
+    def get_text(self, strip=False):
+        return self.node.text(deep=True, separator="", strip=strip)
+
+    def find(self, name):
+        node = self.node.css_first(name)
+        if node is not None and node == self.node:
+            # css() incluye al propio nodo si coincide; find() de BeautifulSoup no
+            node = next(iter(self.node.css(name)[1:]), None)
+        return SelectolaxElement(node) if node is not None else None
+
+    def find_all(self, names):
+        selector = names if isinstance(names, str) else ", ".join(names)
+        return [SelectolaxElement(node) for node in self.node.css(selector) if node != self.node]
+
+
+def process_html_for_escpos(p, html_content, paper_size="80mm", font_size='normal', test_width=False, line_spacing='normal'):
+    """Procesa e imprime HTML con formato según el tamaño de papel y fuente"""
 
+    # Configurar espaciado de líneas al inicio
+    set_line_spacing(p, line_spacing)
+
+    # Obtener ancho de caracteres según papel y fuente
+    char_width = get_char_width(paper_size, font_size)
+    print(f"Ancho de caracteres para papel {paper_size} con fuente {font_size}: {char_width} caracteres por línea")
+    # Imprimir prueba de ancho si se solicita
+    if test_width:
+        print_char_width_test(p, paper_size)
+    
+    # DEBUG: Mostrar longitud del HTML y primeros caracteres
+    # print(f"HTML DEBUG: Longitud: {len(html_content)} caracteres")
+    # print(f"HTML DEBUG: Primeros 200 chars: {html_content[:200]}")
+
+    # Capacidad de la impresora según su perfil, decidida una vez por ticket
+    raw_format = not p.profile.features.get("starCommands", False)
+    hr_width = int(get_char_width(paper_size, font_size, 'wide'))
+    ctx = RenderContext(paper_size, font_size, line_spacing, char_width, raw_format, hr_width)
+
+    # Iniciar el procesamiento desde los elementos de nivel superior
+    if SELECTOLAX_AVAILABLE:
+        body = SelectolaxElement(LexborHTMLParser(html_content).body)
+    else:
+        soup = BeautifulSoup(html_content, HTML_PARSER)
+        body = soup.find('body') or soup
+
+    # El recuento de imágenes solo se calcula si el log de depuración está activo
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Imágenes encontradas en el HTML: {len(body.find_all('img'))}")
+
+    _walk(body.children, p, ctx)
+
+
+# Segundos durante los que se reutiliza la última enumeración de impresoras
+PRINTER_CACHE_TTL = 5.0
+
+def ttl_cache(seconds):
+    """Cachea durante `seconds` segundos el resultado (una lista) de una función sin argumentos"""
+    def decorator(func):
+        cache = {"t": None, "v": None}
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper():
+            with lock:
+                now = time.monotonic()
+                if cache["t"] is None or now - cache["t"] >= seconds:
+                    cache["v"] = func()
+                    cache["t"] = now
+                # Copia para que quien llama pueda modificar la lista sin tocar la caché
+                return list(cache["v"])
+        return wrapper
+    return decorator
+
+@ttl_cache(PRINTER_CACHE_TTL)
 def get_usb_printers():
     """Obtener impresoras USB disponibles"""
     printers = []
@@ -972,50 +1299,66 @@ def get_usb_printers():
     
     return printers
 
-def get_network_printers():
+async def _probe_network_printer(ip, port, timeout=2.0):
+    """Comprueba si la impresora acepta conexiones TCP sin bloquear el event loop"""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return "offline"
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return "available"
+
+async def get_network_printers():
     """Obtener impresoras de red disponibles"""
     printers = []
     
-    # Agregar impresoras de red desde la configuración
-    if "network" in config["printers"]:
-        network_config = config["printers"]["network"]
-        ip = network_config.get("ip")
-        port = network_config.get("port", 9100)
-        
-        if ip:
-            # Verificar si la impresora está disponible
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(2)
-                result = sock.connect_ex((ip, port))
-                sock.close()
-                
-                status = "available" if result == 0 else "offline"
-                printers.append({
-                    "name": f"Network_Printer_{ip}",
-                    "connection_type": "network",
-                    "status": status,
-                    "description": f"IP: {ip}, Puerto: {port}",
-                    "puerto": str(port)
-                })
-            except Exception as e:
-                logger.error(f"Error al verificar impresora de red: {e}")
-                printers.append({
-                    "name": f"Network_Printer_{ip}",
-                    "connection_type": "network",
-                    "status": "error",
-                    "description": f"IP: {ip}, Puerto: {port} - Error: {str(e)}",
-                    "puerto": str(port)
-                })
+    # Agregar impresoras de red desde la configuración (un objeto o una lista de ellos)
+    network_config = config["printers"].get("network")
+    if isinstance(network_config, dict):
+        network_config = [network_config]
+    targets = [
+        (entry["ip"], entry.get("port", 9100))
+        for entry in network_config or []
+        if entry.get("ip")
+    ]
+    
+    # Verificar todas las impresoras a la vez con un mismo plazo
+    results = await asyncio.gather(
+        *(_probe_network_printer(ip, port) for ip, port in targets),
+        return_exceptions=True,
+    )
+    for (ip, port), result in zip(targets, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error al verificar impresora de red: {result}")
+            printers.append({
+                "name": f"Network_Printer_{ip}",
+                "connection_type": "network",
+                "status": "error",
+                "description": f"IP: {ip}, Puerto: {port} - Error: {str(result)}",
+                "puerto": str(port)
+            })
+        else:
+            printers.append({
+                "name": f"Network_Printer_{ip}",
+                "connection_type": "network",
+                "status": result,
+                "description": f"IP: {ip}, Puerto: {port}",
+                "puerto": str(port)
+            })
     
     return printers
 
+@ttl_cache(PRINTER_CACHE_TTL)
 def get_system_printers():
     """Obtener impresoras del sistema"""
     printers = []
     
     try:
-        if platform.system() == "Windows":
+        if PLATFORM_SYSTEM == "Windows":
             # Método 1: Usar win32print si está disponible
             if WIN32_AVAILABLE:
                 try:
@@ -1036,38 +1379,22 @@ def get_system_printers():
                 except Exception as e:
                     logger.warning(f"Error con win32print: {e}")
             
-            # Método 2: Fallback con PowerShell si win32print falla
-            if not printers:
+            # Método 2: Fallback con WMI (Win32_Printer) si win32print falla
+            if not printers and WIN32COM_AVAILABLE:
                 try:
-                    result = subprocess.run([
-                        "powershell", "-Command", 
-                        "Get-Printer | Select-Object Name, DriverName, PortName, PrinterStatus | ConvertTo-Json"
-                    ], capture_output=True, text=True, shell=True)
-                    
-                    if result.returncode == 0:
-                        try:
-                            printer_data = json.loads(result.stdout)
-                            if isinstance(printer_data, dict):
-                                printer_data = [printer_data]
-                            
-                            for printer in printer_data:
-                                status = "available"
-                                if printer.get("PrinterStatus"):
-                                    status = "offline" if "offline" in str(printer["PrinterStatus"]).lower() else "available"
-                                
-                                printers.append({
-                                    "name": printer["Name"],
-                                    "connection_type": "system",
-                                    "status": status,
-                                    "description": f"Driver: {printer.get('DriverName', 'N/A')}, Puerto: {printer.get('PortName', 'N/A')}",
-                                    "puerto": printer.get('PortName', 'N/A')
-                                })
-                        except json.JSONDecodeError as e:
-                            logger.error(f"Error al parsear salida de PowerShell: {e}")
+                    wmi = win32com.client.GetObject("winmgmts:")
+                    for printer in wmi.InstancesOf("Win32_Printer"):
+                        printers.append({
+                            "name": printer.Name,
+                            "connection_type": "system",
+                            "status": "offline" if printer.WorkOffline else "available",
+                            "description": f"Driver: {printer.DriverName or 'N/A'}, Puerto: {printer.PortName or 'N/A'}",
+                            "puerto": printer.PortName or 'N/A'
+                        })
                 except Exception as e:
-                    logger.error(f"Error con PowerShell: {e}")
+                    logger.error(f"Error con WMI: {e}")
         
-        elif platform.system() == "Linux":
+        elif PLATFORM_SYSTEM == "Linux":
             # Usar lpstat para Linux
             result = subprocess.run(["lpstat", "-p"], capture_output=True, text=True)
             if result.returncode == 0:
@@ -1791,7 +2118,7 @@ async def list_prints() -> List[PrinterInfo]:
     all_printers.extend(usb_printers)
     
     # Obtener impresoras de red
-    network_printers = get_network_printers()
+    network_printers = await get_network_printers()
     all_printers.extend(network_printers)
     
     # Obtener impresoras del sistema
@@ -1846,14 +2173,16 @@ async def send_printer(request: PrintRequest):
                 printer_used=request.printer
             )
         
-        # Determinar método de impresión basado en el tipo de impresora
+        # Determinar método de impresión basado en el tipo de impresora.
+        # Cada intento corre en un hilo para no bloquear el event loop mientras se imprime;
+        # los métodos se prueban en orden y no en paralelo, que imprimiría el ticket varias veces
         if "usb" in request.printer.lower():
             # Intentar impresión USB
-            success, message = print_html(request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
+            success, message = await asyncio.to_thread(print_html, request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
             
         elif "network" in request.printer.lower():
             # Intentar impresión de red
-            success, message = print_html(request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
+            success, message = await asyncio.to_thread(print_html, request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
             
         else:
             # Para impresoras del sistema, intentar múltiples métodos        
@@ -1863,7 +2192,7 @@ async def send_printer(request: PrintRequest):
             # Método 1: ESCPOS con Win32Raw (mejor para térmicas)
             try:
                 # print(f"Método 1: ESCPOS con Win32Raw (papel: {request.size}, fuente: {request.font_size})")
-                success, message = print_html(request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
+                success, message = await asyncio.to_thread(print_html, request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
                 # success, message = print_with_escpos_system(content, request.printer)
                 methods_tried.append("ESCPOS")
                 if success:
@@ -1876,7 +2205,7 @@ async def send_printer(request: PrintRequest):
             if not success and WIN32_AVAILABLE:
                 try:
                     # print(f"Método 2: Impresión RAW (papel: {request.size}, fuente: {request.font_size})")
-                    success, message = print_html(request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
+                    success, message = await asyncio.to_thread(print_html, request.printer, request.html, request.size, request.font_size, request.test_width, request.line_spacing)
                     methods_tried.append("RAW")
                     if success:
                         logger.info("Impresión RAW exitosa")
@@ -1888,7 +2217,7 @@ async def send_printer(request: PrintRequest):
             if not success:
                 try:
                     # print(f"Método 3: Impresión del sistema (papel: {request.size}, fuente: {request.font_size})")
-                    success, message = print_html(request.printer, request.html, request.size, request.font_size, request.test_width)
+                    success, message = await asyncio.to_thread(print_html, request.printer, request.html, request.size, request.font_size, request.test_width)
                     methods_tried.append("Sistema")
                     if success:
                         logger.info("Impresión del sistema exitosa")
@@ -1909,6 +2238,32 @@ async def send_printer(request: PrintRequest):
         logger.error(f"Error en send_printer: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
 
+@app.post("/send_printer_batch", response_model=List[PrintResponse])
+async def send_printer_batch(tickets: List[PrintRequest]):
+    """Enviar varios tickets HTML a imprimir; los de una misma impresora van en un solo trabajo"""
+    responses = [None] * len(tickets)
+    by_printer = {}
+    for i, ticket in enumerate(tickets):
+        if ticket.size not in ["80mm", "58mm"]:
+            responses[i] = PrintResponse(success=False, message="Tamaño de papel debe ser '80mm' o '58mm'")
+        elif not ticket.html.strip():
+            responses[i] = PrintResponse(success=False, message="El contenido HTML no puede estar vacío")
+        elif ticket.printer == "Impresora_Virtual":
+            responses[i] = PrintResponse(
+                success=True,
+                message="Impresión virtual exitosa (no se imprimió realmente)",
+                printer_used=ticket.printer
+            )
+        else:
+            by_printer.setdefault(ticket.printer, []).append(i)
+
+    # Renderizar y escribir bloquea: cada impresora se atiende fuera del event loop
+    for printer_name, indexes in by_printer.items():
+        results = await asyncio.to_thread(print_html_batch, printer_name, [tickets[i] for i in indexes])
+        for i, (success, message) in zip(indexes, results):
+            responses[i] = PrintResponse(success=success, message=message, printer_used=printer_name if success else None)
+    return responses
+
 
 if __name__ == "__main__":
     try:
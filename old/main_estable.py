@@ -1,25 +1,36 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 import json
 import os
 import platform
 import subprocess
 import re
+import textwrap
+import hashlib
+import threading
+import time
+import asyncio
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from functools import lru_cache, wraps
+from contextlib import asynccontextmanager
 from typing import List, Dict, Optional
 import logging
 from escpos.printer import Usb, Network, Dummy, Win32Raw
-from escpos.exceptions import USBNotFoundError, Error
+from escpos.exceptions import USBNotFoundError, Error, ImageWidthError
 from escpos.image import EscposImage
 import usb.core
-import socket
-import tempfile
 from io import BytesIO
-from PIL import Image
-import html2text
+from html.parser import HTMLParser
+from PIL import Image, ImageChops, UnidentifiedImageError
 import qrcode
 import base64
+import binascii
 from bs4 import BeautifulSoup
 
 # Configurar logging
@@ -29,18 +40,111 @@ logger = logging.getLogger(__name__)
 # Importación condicional de win32print
 try:
     import win32print
+    import win32file
     WIN32_AVAILABLE = True
 except ImportError:
     WIN32_AVAILABLE = False
     logger.warning("win32print no disponible - algunas funciones de impresión limitadas")
 
+# Sistema operativo, no cambia en tiempo de ejecución
+PLATFORM_SYSTEM = platform.system()
+
+# Importación condicional de orjson (serialización JSON de las respuestas en C)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Importación condicional de selectolax (parser HTML en C, mucho más rápido que BeautifulSoup)
+try:
+    from selectolax.lexbor import LexborHTMLParser
+    SELECTOLAX_AVAILABLE = True
+except ImportError:
+    SELECTOLAX_AVAILABLE = False
+
+# Comandos ESC/POS precalculados, idénticos a los que genera p.set() para cada etiqueta
+ESC_BOLD_ON = b"\x1b\x45\x01"
+ESC_BOLD_OFF = b"\x1b\x45\x00"
+ESC_UNDERLINE_ON = b"\x1b\x2d\x01"
+# Trabajos RAW: inicializar la impresora y, al final, avanzar 2 líneas y cortar
+ESC_INIT = b"\x1b\x40"
+ESC_FEED2_CUT = b"\x1b\x64\x02" + b"\x1d\x56\x41\x10"
+# Comandos ESC a n (alineación)
+ALIGN_CMD = {"left": b"\x1b\x61\x00", "center": b"\x1b\x61\x01", "right": b"\x1b\x61\x02"}
+# Encabezados: p.set(align="center", bold=True, width=size, height=size); sin
+# custom_size python-escpos no emite el tamaño, así que h1 y h2-h6 son iguales
+STYLE_HEADING = ESC_BOLD_ON + ALIGN_CMD["center"]
+STYLE_PARAGRAPH = ESC_BOLD_OFF + ALIGN_CMD["left"]
+
+# Tipografía que la página de códigos de la impresora no tiene: sustituirla por
+# ASCII en una sola pasada evita que python-escpos cambie de página (ESC t) a mitad de línea
+_TEXT_TRANSLATION = str.maketrans({
+    "\u2013": "-",    # –
+    "\u2014": "-",    # —
+    "\u2018": "'",    # ‘
+    "\u2019": "'",    # ’
+    "\u201c": '"',    # “
+    "\u201d": '"',    # ”
+    "\u2026": "...",  # …
+    "\u00a0": " ",    # espacio duro
+})
+
+# Expresiones regulares precompiladas (se usan en cada impresión)
+_RE_WIDTH_HEIGHT_PX = re.compile(r"(width|height)\s*:\s*(\d+)px")
+_RE_STYLE = re.compile(r'style\s*=\s*"([^"]+)"')
+_RE_TEXT_ALIGN = re.compile(r'text-align\s*:\s*(left|center|right)')
+_RE_QR_DIV = re.compile(r'<div id="(qr-[^"]+)"[^>]*>.*?</div>', re.DOTALL)
+_RE_IMAGE_MARKER = re.compile(r'\[IMAGE_(\d+)\]')
+_RE_PLACEHOLDER = re.compile(r'\[IMG_PLACEHOLDER_(\d+)\]')
+# Estilos inline que lee la plantilla comentada de print_content_with_images
+_RE_INLINE_STYLE = re.compile(r'<(\w+)([^>]*)style="([^"]*)"[^>]*>([^<]*)</\1>')
+_RE_FONT_SIZE = re.compile(r'font-size:\s*(\d+)px')
+_RE_FONT_FAMILY = re.compile(r'font-family:\s*([^;]+);?')
+_RE_COLOR = re.compile(r'color:\s*([^;]+);?')
+_RE_MARGIN_TOP = re.compile(r'margin-top:\s*(\d+)')
+_RE_MARGIN_BOTTOM = re.compile(r'margin-bottom:\s*(\d+)')
+_RE_DIV_IMG = re.compile(r'<div([^>]*)>(\s*)<img([^>]*)src="(data:image/[^;]+;base64,[^"]+)"([^>]*)>(.*?)</div>', re.DOTALL)
+
+
+# qrcode.js se sirve desde static/ si se copió allí (sin depender del CDN); si no, desde unpkg
+QRCODE_JS_CDN = "https://unpkg.com/qrcode@1.5.3/build/qrcode.min.js"
+QRCODE_JS_LOCAL = os.path.join("static", "qrcode.min.js")
+QRCODE_JS_SRC = "/static/qrcode.min.js" if os.path.isfile(QRCODE_JS_LOCAL) else QRCODE_JS_CDN
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serializada con orjson: las respuestas llevan data URIs de varios KB"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Un QR descartable al arrancar: el primer QR real no paga la carga de los
+    # plugins de PIL ni la inicialización de qrcode
+    try:
+        qr_to_base64(generate_qr_image("warmup", (64, 64)))
+    except Exception as e:
+        logger.warning(f"No se pudo calentar la generación de QR: {e}")
+    yield
+    shutdown_qr_pool()
+
 
 app = FastAPI(
     title="PrintPOS API",
     description="API para impresión de tickets POS en impresoras térmicas",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse if ORJSON_AVAILABLE else JSONResponse,
+    lifespan=lifespan
 )
 
+# Las respuestas con data URIs base64 y la página principal se comprimen bien
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+if QRCODE_JS_SRC != QRCODE_JS_CDN:
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+
 # Modelos Pydantic
 class PrintRequest(BaseModel):
     printer: str
@@ -84,32 +188,49 @@ if not config:
 
 
 
+def write_raw_to_printer(printer_name, data):
+    """Envía un bloque de bytes ESC/POS a la cola de Windows en una sola escritura"""
+    handle = win32print.OpenPrinter(printer_name)
+    try:
+        win32print.StartDocPrinter(handle, 1, ("PrintPOS", None, "RAW"))
+        try:
+            win32print.StartPagePrinter(handle)
+            win32print.WritePrinter(handle, data)
+            win32print.EndPagePrinter(handle)
+        finally:
+            win32print.EndDocPrinter(handle)
+    finally:
+        win32print.ClosePrinter(handle)
+
+
 def print_html(printer_name, html_content):
     
     """Imprimir usando escpos con impresora del sistema"""
     print(f"Imprimir usando escpos con impresora del sistema: {printer_name}")
     try:
-        from escpos import printer
-        
-        # Intentar usar Win32Raw si está disponible
+        # Generar el ticket en memoria: cada p.text/p.set sobre Win32Raw
+        # sería una escritura independiente a la impresora
+        p = Dummy()
+        process_html_for_escpos(p, html_content)
+        body = p.output
+
+        # Enviar el buffer completo en una sola escritura si win32print está disponible
         if WIN32_AVAILABLE:
             try:
-                p = printer.Win32Raw(printer_name)
-                process_html_for_escpos(p, html_content)                
                 p.text("Grácias por usar PrintPOS!")
                 # p.text(str(content))
             
                 # p.ln(2)
                 p.cut()
-                p.close()
+                write_raw_to_printer(printer_name, p.output)
                 print(f"Impresión ESCPOS exitosa en {printer_name}")
                 return True, f"Impresión ESCPOS exitosa en {printer_name}"
             except Exception as e:
                 logger.warning(f"Win32Raw falló: {e}")
         
-        # Fallback: usar Dummy printer_name para debug
-        p = printer.Dummy()
-        process_html_for_escpos(p, html_content)
+        # Fallback: sin impresora real, solo mostrar el contenido para debug
+        p = Dummy()
+        p._raw(body)
         p.cut()
         output = p.output
         print(f"Contenido que se enviaría a imprimir: {output[:200]}...")
@@ -121,143 +242,353 @@ def print_html(printer_name, html_content):
         return False, f"Error en impresión ESCPOS: {str(e)}"
     
 
-def process_html_for_escpos(p, html_content):
-    """Procesa e imprime HTML con formato"""
+# Caché LRU de imágenes base64 ya decodificadas y redimensionadas (logos que se reimprimen)
+IMAGE_CACHE_SIZE = 64
+_image_cache = OrderedDict()
+_image_cache_lock = threading.Lock()
 
-    soup = BeautifulSoup(html_content, "html.parser")
 
-    for element in soup.descendants:
-        if not hasattr(element, 'name') or element.name is None:
-            continue
+def _fast_resize(image, width, height):
+    """
+    Redimensiona para la impresora térmica: promedio por área (BOX) al reducir y
+    bilineal al ampliar; LANCZOS no aporta nada visible en un cabezal de 203 dpi
+    """
+    # En JPEG, draft() hace que libjpeg decodifique ya reducido (escala DCT)
+    image.draft(None, (width, height))
+    orig_w, orig_h = image.size
+    if width * height < orig_w * orig_h:
+        return image.resize((width, height), Image.Resampling.BOX)
+    return image.resize((width, height), Image.Resampling.BILINEAR)
 
-        # Encabezados h1 - h6
-        if element.name in [f"h{i}" for i in range(1, 7)]:
-            size = 2 if element.name == "h1" else 1
-            p.set(align="center", bold=True, width=size, height=size)
-            p.text(element.get_text(strip=True) + "\n\n")
-
-        # Párrafos
-        elif element.name == "p":
-            p.set(align="left", bold=False)
-            p.text(element.get_text(strip=True) + "\n")
-
-        # Negrita, cursiva, subrayado
-        elif element.name == "b":
-            p.set(bold=True)
-            p.text(element.get_text(strip=True) + "\n")
-
-        elif element.name == "i":
-            p.set(italic=True)
-            p.text(element.get_text(strip=True) + "\n")
-
-        elif element.name == "u":
-            p.set(underline=1)
-            p.text(element.get_text(strip=True) + "\n")
-
-        # Centrados
-        elif element.name == "center":
-            p.set(align="center")
-            p.text(element.get_text(strip=True) + "\n")
-
-        # Imágenes Base64
-        elif element.name == "img":
-            src = element.get("src", "")
-            if "base64" in src:
-                img_b64 = src.split(",")[1]
-                image_data = base64.b64decode(img_b64)
-                image = Image.open(BytesIO(image_data))
-
-                # Obtener dimensiones desde atributos width/height o style
-                width = None
-                height = None
-                # Atributos directos
-                if element.has_attr("width"):
-                    try:
-                        width = int(element["width"])
-                    except:
-                        pass
-                if element.has_attr("height"):
-                    try:
-                        height = int(element["height"])
-                    except:
-                        pass
-                # Buscar en style
-                if element.has_attr("style"):
-                    style = element["style"]
-                    import re
-                    width_match = re.search(r"width\s*:\s*(\d+)px", style)
-                    height_match = re.search(r"height\s*:\s*(\d+)px", style)
-                    if width_match:
-                        width = int(width_match.group(1))
-                    if height_match:
-                        height = int(height_match.group(1))
-
-                # Redimensionar si corresponde
-                if width or height:
-                    orig_w, orig_h = image.size
-                    new_w = width if width else orig_w
-                    new_h = height if height else orig_h
-                    image = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
-
-                p.image(image)
-                p.text("\n")
-            elif element.get("data-type") == "qr":
-                data = element.get("data-value", "")
-                if data:
-                    p.qr(data, size=8)
-                    p.text("\n")
-
-        # Código de barras
-        elif element.name == "barcode":
-            code = element.get_text(strip=True)
-            barcode_type = element.get("type", "CODE128")
-            p.barcode(code, barcode_type, width=2, height=80, pos="BELOW", font="A")
-            p.text("\n")
 
-        # Tablas
-        elif element.name == "table":
-            for tr in element.find_all("tr"):
-                cols = [td.get_text(strip=True) for td in tr.find_all(["td", "th"])]
-                if not cols:
-                    continue
-                # Ajuste simple: ancho proporcional al número de columnas
-                col_width = int(48 / len(cols))
-                line = "".join(c[:col_width].ljust(col_width) for c in cols)
-                p.text(line + "\n")
-            p.text("\n")
+# Tabla para point(): deja en 0 los píxeles que ya son blanco o negro puros
+_NOT_BILEVEL_LUT = [0] + [255] * 254 + [0]
+
+
+def to_thermal_bitmap(image):
+    """Convierte una imagen a 1 bit sobre fondo blanco con tramado Floyd-Steinberg"""
+    if image.mode in ("RGBA", "LA", "P"):
+        # Quitar transparencia pegando sobre blanco, igual que EscposImage
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        image = background
+    image = image.convert("L")
+    # Logos ya en blanco y negro: el umbral da los mismos píxeles que el tramado, mucho más rápido
+    if image.point(_NOT_BILEVEL_LUT).getbbox() is None:
+        return image.convert("1", dither=Image.Dither.NONE)
+    return image.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+
+
+# Tamaño máximo de cada bloque GS v 0, el mismo fragment_height que usa Escpos.image()
+RASTER_FRAGMENT_HEIGHT = 960
+
+
+def print_raster_image(p, image):
+    """
+    Envía una imagen con GS v 0 (alta densidad), con los mismos bytes que
+    p.image(image, impl="bitImageRaster"). Si la imagen ya es de 1 bit se
+    empaqueta directamente, sin la conversión RGBA -> L -> 1 de EscposImage.
+    """
+    if image.mode != "1":
+        p.image(image, impl="bitImageRaster")
+        return
+    try:
+        max_width = int(p.profile.profile_data["media"]["width"]["pixels"])
+        if image.width > max_width:
+            raise ImageWidthError(f"{image.width} > {max_width}")
+    except (KeyError, ValueError):
+        # Ancho del perfil desconocido: se imprime igual, como python-escpos
+        pass
+    width_bytes = (image.width + 7) >> 3
+    for upper in range(0, image.height, RASTER_FRAGMENT_HEIGHT):
+        fragment = image.crop((0, upper, image.width, min(upper + RASTER_FRAGMENT_HEIGHT, image.height)))
+        # En ESC/POS el bit 1 es un punto negro: al revés que en el modo 1 de PIL
+        p._raw(
+            b"\x1dv0\x00"
+            + width_bytes.to_bytes(2, "little")
+            + fragment.height.to_bytes(2, "little")
+            + ImageChops.invert(fragment).tobytes()
+        )
+
+
+# Formato de PIL según el tipo MIME del data URI, para que Image.open no pruebe cada plugin
+_MIME_FORMATS = {
+    "image/png": "PNG", "image/jpeg": "JPEG", "image/jpg": "JPEG",
+    "image/gif": "GIF", "image/bmp": "BMP", "image/webp": "WEBP",
+}
+
+
+def image_format_hint(src):
+    """Formato de PIL declarado en un data URI (data:image/png;base64,...) o None"""
+    if not src.startswith("data:"):
+        return None
+    return _MIME_FORMATS.get(src[5:src.find(";")].strip().lower())
+
+
+def open_image_bytes(data, fmt=None):
+    """Image.open sobre bytes, probando primero solo el formato indicado"""
+    if fmt:
+        try:
+            return Image.open(BytesIO(data), formats=(fmt,))
+        except UnidentifiedImageError:
+            # El MIME no coincidía con el contenido: probar todos los formatos
+            pass
+    return Image.open(BytesIO(data))
+
+
+def decode_base64_image(b64_data, width=None, height=None, fmt=None):
+    """
+    Decodifica una imagen base64, la redimensiona si se indica y la trama a 1 bit
+    (en C, para que python-escpos no tenga que hacerlo); una imagen repetida sale de la caché
+    """
+    # Codificar una sola vez: los mismos bytes sirven para la clave y para decodificar
+    if isinstance(b64_data, str):
+        b64_data = b64_data.encode("ascii")
+    key = (hashlib.sha1(b64_data).digest(), width, height)
+    with _image_cache_lock:
+        image = _image_cache.get(key)
+        if image is not None:
+            _image_cache.move_to_end(key)
+            return image
+
+    image = open_image_bytes(binascii.a2b_base64(b64_data), fmt)
+    if width or height:
+        orig_w, orig_h = image.size
+        new_w = width if width else orig_w
+        new_h = height if height else orig_h
+        image = _fast_resize(image, new_w, new_h)
+    image = to_thermal_bitmap(image)
+    remember_decoded_image(key, image)
+    return image
+
+
+def remember_decoded_image(key, image):
+    """Guardar en la caché de decode_base64_image una imagen ya tramada"""
+    with _image_cache_lock:
+        _image_cache[key] = image
+        if len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+
+
+def style_dimensions(style):
+    """(width, height) en px de un style; gana la primera aparición de cada uno, como re.search"""
+    dims = {}
+    for name, value in _RE_WIDTH_HEIGHT_PX.findall(style):
+        dims.setdefault(name, int(value))
+    return dims.get("width"), dims.get("height")
+
+
+def _node_text(node):
+    """Texto del nodo sin espacios sobrantes (selectolax o BeautifulSoup)"""
+    if SELECTOLAX_AVAILABLE:
+        return node.text(deep=True, strip=True)
+    return node.get_text(strip=True)
+
+
+def _ticket_text(node):
+    """Texto del nodo listo para imprimir, con la tipografía pasada a ASCII"""
+    return _node_text(node).translate(_TEXT_TRANSLATION)
+
+
+def _node_attrs(node):
+    """Atributos del nodo como diccionario plano"""
+    return node.attributes if SELECTOLAX_AVAILABLE else node.attrs
+
+
+def _parse_html(html_content):
+    """Nodo raíz del HTML parseado"""
+    if SELECTOLAX_AVAILABLE:
+        return LexborHTMLParser(html_content).root
+    return BeautifulSoup(html_content, "html.parser")
+
+
+def _node_tag(node):
+    return node.tag if SELECTOLAX_AVAILABLE else node.name
+
+
+def _element_children(node):
+    """Hijos de tipo elemento, sin nodos de texto"""
+    if SELECTOLAX_AVAILABLE:
+        return list(node.iter(include_text=False))
+    return [child for child in node.children if child.name is not None]
+
+
+def _table_rows(node):
+    """Filas de una tabla como listas de textos de celda"""
+    if SELECTOLAX_AVAILABLE:
+        return [[_node_text(td) for td in tr.css("td, th")] for tr in node.css("tr")]
+    return [[_node_text(td) for td in tr.find_all(["td", "th"])] for tr in node.find_all("tr")]
+
+
+def _emit_heading(p, node):
+    p._raw(STYLE_HEADING)
+    p.text(_ticket_text(node) + "\n\n")
+
+
+def _emit_paragraph(p, node):
+    p._raw(STYLE_PARAGRAPH)
+    p.text(_ticket_text(node) + "\n")
+
+
+def _emit_bold(p, node):
+    p._raw(ESC_BOLD_ON)
+    p.text(_ticket_text(node) + "\n")
+
+
+def _emit_italic(p, node):
+    p.set(italic=True)
+    p.text(_ticket_text(node) + "\n")
+
 
-        # Código QR directo (etiqueta personalizada)
-        elif element.name == "qr":
-            data = element.get_text(strip=True)
+def _emit_underline(p, node):
+    p._raw(ESC_UNDERLINE_ON)
+    p.text(_ticket_text(node) + "\n")
+
+
+def _emit_center(p, node):
+    p._raw(ALIGN_CMD["center"])
+    p.text(_ticket_text(node) + "\n")
+
+
+def _emit_img(p, node):
+    attrs = _node_attrs(node)
+    src = attrs.get("src") or ""
+    # Sólo data URIs: un <img data-type="qr"> lleva src="/qr.png?data=..." para la vista previa
+    if src.startswith("data:") and "base64" in src:
+        img_b64 = src[src.index(",") + 1:]
+
+        # Obtener dimensiones desde atributos width/height o style
+        width = None
+        height = None
+        # Atributos directos
+        if "width" in attrs:
+            try:
+                width = int(attrs["width"])
+            except:
+                pass
+        if "height" in attrs:
+            try:
+                height = int(attrs["height"])
+            except:
+                pass
+        # Buscar en style
+        if "style" in attrs:
+            style_width, style_height = style_dimensions(attrs["style"] or "")
+            if style_width is not None:
+                width = style_width
+            if style_height is not None:
+                height = style_height
+
+        # Decodificar y redimensionar si corresponde
+        image = decode_base64_image(img_b64, width, height, image_format_hint(src))
+        print_raster_image(p, image)
+        p.text("\n")
+    elif attrs.get("data-type") == "qr":
+        data = attrs.get("data-value") or ""
+        if data:
             p.qr(data, size=8)
             p.text("\n")
 
 
+def _emit_barcode(p, node):
+    code = _node_text(node)
+    barcode_type = _node_attrs(node).get("type") or "CODE128"
+    p.barcode(code, barcode_type, width=2, height=80, pos="BELOW", font="A")
+    p.text("\n")
+
+
+def _emit_table(p, node):
+    for cols in _table_rows(node):
+        if not cols:
+            continue
+        # Ajuste simple: ancho proporcional al número de columnas
+        col_width = int(48 / len(cols))
+        line = "".join(c.translate(_TEXT_TRANSLATION)[:col_width].ljust(col_width) for c in cols)
+        p.text(line + "\n")
+    p.text("\n")
+
+
+def _emit_qr(p, node):
+    data = _node_text(node)
+    p.qr(data, size=8)
+    p.text("\n")
+
+
+_HEADING_TAGS = frozenset({"h1", "h2", "h3", "h4", "h5", "h6"})
+
+# Tabla de despacho etiqueta -> función que emite los comandos ESC/POS
+ELEMENT_HANDLERS = {
+    **dict.fromkeys(_HEADING_TAGS, _emit_heading),
+    "p": _emit_paragraph,
+    "b": _emit_bold,
+    "i": _emit_italic,
+    "u": _emit_underline,
+    "center": _emit_center,
+    "img": _emit_img,
+    "barcode": _emit_barcode,
+    "table": _emit_table,
+    "qr": _emit_qr,
+}
+
+
+# Elementos que se imprimen aunque estén dentro de otro ya impreso: el texto
+# plano del contenedor no los representa
+_EMBEDDED_TAGS = frozenset({"img", "barcode", "table", "qr"})
+
+
+def _is_plain_text(html_content):
+    """True si el contenido no tiene etiquetas ni entidades HTML"""
+    return "<" not in html_content and "&" not in html_content
+
+
+def process_html_for_escpos(p, html_content):
+    """Procesa e imprime HTML con formato"""
+    # Ticket de texto plano: no hace falta parsear nada
+    if _is_plain_text(html_content):
+        p.text(html_content if html_content.endswith("\n") else html_content + "\n")
+        return
+    # Pila de (nodo, dentro de un elemento ya impreso) en orden de documento
+    stack = [(_parse_html(html_content), False)]
+    while stack:
+        node, inside = stack.pop()
+        tag = _node_tag(node)
+        handler = ELEMENT_HANDLERS.get(tag)
+        # El texto de un elemento ya incluye el de sus hijos (<b> dentro de <h1>
+        # salía dos veces); dentro de él solo se emiten los elementos embebidos
+        if handler and (not inside or tag in _EMBEDDED_TAGS):
+            handler(p, node)
+        inside = inside or handler is not None
+        stack.extend((child, inside) for child in reversed(_element_children(node)))
+
+
 # Funciones auxiliares
+def qr_document_info(html_content: str):
+    """Hash del documento, su módulo 10000 y la fecha de hoy; comunes a todos los QR de un HTML"""
+    doc_hash = hash(html_content)
+    return doc_hash, doc_hash % 10000, datetime.datetime.now().strftime('%d/%m/%Y')
+
+def qr_data_for_element(element_id: str, doc_info) -> str:
+    """Datos del QR según el tipo indicado en el id del div (qr-ticket, qr-receipt, qr-invoice)"""
+    doc_hash, doc_mod, today = doc_info
+    if "qr-ticket" in element_id:
+        return f"TICKET-{doc_mod}\nFecha: {today}\nVerificar compra"
+    elif "qr-receipt" in element_id:
+        return f"COMPROBANTE-{doc_mod}\nPago de servicios\nVerificar pago"
+    elif "qr-invoice" in element_id:
+        return f"CFDI-UUID: {doc_hash}\nRFC: CEJ123456789\nVerificar factura"
+    return f"Código QR - {element_id}"
+
 def process_qr_codes_in_html(html_content: str) -> str:
-    """Procesar elementos QR en HTML y reemplazarlos con imágenes generadas"""
+    """Procesar elementos QR en HTML y reemplazarlos con imágenes generadas (vista previa en el navegador)"""
     try:
-        import re
-        
-        # Buscar elementos div con id que contengan "qr-"
-        qr_pattern = r'<div id="(qr-[^"]+)"[^>]*>.*?</div>'
-        
+        # Invariantes del documento: se calculan una vez, no por cada QR
+        doc_info = qr_document_info(html_content)
+
         def replace_qr(match):
-            element_id = match.group(1)
-            
-            # Generar datos QR basados en el tipo
-            if "qr-ticket" in element_id:
-                qr_data = f"TICKET-{hash(html_content) % 10000}\nFecha: {import_datetime().datetime.now().strftime('%d/%m/%Y')}\nVerificar compra"
-            elif "qr-receipt" in element_id:
-                qr_data = f"COMPROBANTE-{hash(html_content) % 10000}\nPago de servicios\nVerificar pago"
-            elif "qr-invoice" in element_id:
-                qr_data = f"CFDI-UUID: {hash(html_content)}\nRFC: CEJ123456789\nVerificar factura"
-            else:
-                qr_data = f"Código QR - {element_id}"
-            
             # Generar imagen QR
-            qr_image = generate_qr_image(qr_data, (80, 80))
-            
+            qr_image = generate_qr_image(qr_data_for_element(match.group(1), doc_info), (80, 80))
+
             if qr_image:
                 # Convertir a base64
                 qr_base64 = qr_to_base64(qr_image)
@@ -267,18 +598,37 @@ def process_qr_codes_in_html(html_content: str) -> str:
             # Si falla, retornar texto alternativo
             return '<div style="text-align:center;border:1px solid #000;width:80px;height:80px;margin:5px auto;display:flex;align-items:center;justify-content:center;font-size:10px;">QR CODE</div>'
         
-        # Reemplazar todos los elementos QR
-        processed_html = re.sub(qr_pattern, replace_qr, html_content, flags=re.DOTALL)
+        # Reemplazar todos los elementos div con id que contengan "qr-"
+        processed_html = _RE_QR_DIV.sub(replace_qr, html_content)
         return processed_html
         
     except Exception as e:
         logger.error(f"Error procesando códigos QR: {e}")
         return html_content
 
-def import_datetime():
-    """Importar datetime de manera lazy"""
-    import datetime
-    return datetime
+
+# Segundos que se reutiliza la lista de impresoras (enumerar USB y lanzar PowerShell es lento)
+PRINTER_CACHE_TTL = 30.0
+
+def ttl_cache(seconds):
+    """Cachea durante `seconds` segundos el resultado (una lista) de una función sin argumentos"""
+    def decorator(func):
+        cache = {"t": None, "v": None}
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper():
+            with lock:
+                now = time.monotonic()
+                if cache["t"] is None or now - cache["t"] >= seconds:
+                    cache["v"] = func()
+                    cache["t"] = now
+                # Copia para que quien llama pueda modificar la lista sin tocar la caché
+                return list(cache["v"])
+        return wrapper
+    return decorator
+
+@ttl_cache(PRINTER_CACHE_TTL)
 def get_usb_printers():
     """Obtener impresoras USB disponibles"""
     printers = []
@@ -308,50 +658,66 @@ def get_usb_printers():
     
     return printers
 
-def get_network_printers():
+async def _probe_network_printer(ip, port, timeout=0.5):
+    """Comprueba si la impresora acepta conexiones TCP sin bloquear el event loop"""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return "offline"
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return "available"
+
+async def get_network_printers():
     """Obtener impresoras de red disponibles"""
     printers = []
     
-    # Agregar impresoras de red desde la configuración
-    if "network" in config["printers"]:
-        network_config = config["printers"]["network"]
-        ip = network_config.get("ip")
-        port = network_config.get("port", 9100)
-        
-        if ip:
-            # Verificar si la impresora está disponible
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(2)
-                result = sock.connect_ex((ip, port))
-                sock.close()
-                
-                status = "available" if result == 0 else "offline"
-                printers.append({
-                    "name": f"Network_Printer_{ip}",
-                    "connection_type": "network",
-                    "status": status,
-                    "description": f"IP: {ip}, Puerto: {port}",
-                    "puerto": str(port)
-                })
-            except Exception as e:
-                logger.error(f"Error al verificar impresora de red: {e}")
-                printers.append({
-                    "name": f"Network_Printer_{ip}",
-                    "connection_type": "network",
-                    "status": "error",
-                    "description": f"IP: {ip}, Puerto: {port} - Error: {str(e)}",
-                    "puerto": str(port)
-                })
+    # Agregar impresoras de red desde la configuración (un objeto o una lista de ellos)
+    network_config = config["printers"].get("network")
+    if isinstance(network_config, dict):
+        network_config = [network_config]
+    targets = [
+        (entry["ip"], entry.get("port", 9100))
+        for entry in network_config or []
+        if entry.get("ip")
+    ]
+    
+    # Verificar todas las impresoras a la vez; en la LAN el SYN tarda milisegundos
+    results = await asyncio.gather(
+        *(_probe_network_printer(ip, port) for ip, port in targets),
+        return_exceptions=True,
+    )
+    for (ip, port), result in zip(targets, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error al verificar impresora de red: {result}")
+            printers.append({
+                "name": f"Network_Printer_{ip}",
+                "connection_type": "network",
+                "status": "error",
+                "description": f"IP: {ip}, Puerto: {port} - Error: {str(result)}",
+                "puerto": str(port)
+            })
+        else:
+            printers.append({
+                "name": f"Network_Printer_{ip}",
+                "connection_type": "network",
+                "status": result,
+                "description": f"IP: {ip}, Puerto: {port}",
+                "puerto": str(port)
+            })
     
     return printers
 
+@ttl_cache(PRINTER_CACHE_TTL)
 def get_system_printers():
     """Obtener impresoras del sistema"""
     printers = []
     
     try:
-        if platform.system() == "Windows":
+        if PLATFORM_SYSTEM == "Windows":
             # Método 1: Usar win32print si está disponible
             if WIN32_AVAILABLE:
                 try:
@@ -403,7 +769,7 @@ def get_system_printers():
                 except Exception as e:
                     logger.error(f"Error con PowerShell: {e}")
         
-        elif platform.system() == "Linux":
+        elif PLATFORM_SYSTEM == "Linux":
             # Usar lpstat para Linux
             result = subprocess.run(["lpstat", "-p"], capture_output=True, text=True)
             if result.returncode == 0:
@@ -426,90 +792,275 @@ def get_system_printers():
     
     return printers
 
-def html_to_printer_commands(html_content: str, paper_size: str):
-    """Convertir HTML a comandos de impresora"""
+@lru_cache(maxsize=None)
+def _get_wrapper(chars_per_line):
+    """TextWrapper reutilizable por ancho de línea (palabras largas sin cortar, igual que el ajuste manual)"""
+    return textwrap.TextWrapper(width=chars_per_line, break_long_words=False, break_on_hyphens=False)
+
+# Etiquetas que cortan línea; las de párrafo además dejan una línea en blanco
+_BLOCK_TAGS = frozenset({
+    "div", "center", "tr", "li", "section", "article", "header", "footer", "address", "form",
+})
+_PARAGRAPH_TAGS = frozenset({
+    "p", "h1", "h2", "h3", "h4", "h5", "h6", "table", "ul", "ol", "pre", "blockquote",
+})
+_SKIP_TAGS = frozenset({"script", "style", "head", "title"})
+_VOID_TAGS = frozenset({"br", "hr", "img", "meta", "link", "input", "col", "area", "base", "wbr", "source"})
+
+
+class _TicketTextParser(HTMLParser):
+    """
+    Recorre el HTML en una sola pasada acumulando párrafos (alineación, texto) para el ticket.
+    Si se pasa la lista images, los <div id="qr-..."> y las <img> base64 se agregan a ella
+    como imágenes PIL y en su lugar queda una línea con el marcador [IMAGE_n].
+    """
+
+    def __init__(self, chars_per_line, html_content="", images=None):
+        super().__init__(convert_charrefs=True)
+        self.chars_per_line = chars_per_line
+        self.html_content = html_content
+        self.images = images
+        self.blocks = []  # [(alineación, texto)]; texto "" es una línea en blanco
+        self._stack = [("", "left")]  # (etiqueta, alineación heredada)
+        self._parts = []
+        self._cells = 0
+        self._skip = 0
+        self._in_qr = False
+        self._qr_doc_info = None
+
+    def _flush(self):
+        text = " ".join("".join(self._parts).split())
+        self._parts = []
+        if text:
+            self.blocks.append((self._stack[-1][1], text))
+
+    def _blank(self):
+        if self.blocks and self.blocks[-1][1] != "":
+            self.blocks.append(("left", ""))
+
+    def _add_image(self, image):
+        """Imagen en su propia línea, con la alineación del bloque que la contiene"""
+        self._flush()
+        self.images.append(image)
+        self.blocks.append((self._stack[-1][1], f"[IMAGE_{len(self.images) - 1}]"))
+
+    def _start_qr(self, element_id):
+        # Como la expresión de la vista previa, el QR ocupa hasta el primer </div>
+        self._in_qr = True
+        if self.images is None:
+            return
+        if self._qr_doc_info is None:
+            self._qr_doc_info = qr_document_info(self.html_content)
+        qr_image = generate_qr_image(qr_data_for_element(element_id, self._qr_doc_info), (80, 80))
+        if qr_image:
+            self._add_image(qr_image)
+        else:
+            self._flush()
+            self.blocks.append(("center", "QR CODE"))
+
+    def _start_img(self, attrs):
+        src = attrs.get("src") or ""
+        if self.images is None or not src.startswith("data:image") or ";base64," not in src:
+            return
+        # Dimensiones: atributos width/height, y el style tiene prioridad
+        width = height = None
+        try:
+            width = int(attrs["width"])
+        except (KeyError, TypeError, ValueError):
+            pass
+        try:
+            height = int(attrs["height"])
+        except (KeyError, TypeError, ValueError):
+            pass
+        style_width, style_height = style_dimensions(attrs.get("style") or "")
+        width = style_width if style_width is not None else width
+        height = style_height if style_height is not None else height
+        try:
+            self._add_image(decode_base64_image(src[src.index(",") + 1:], width, height, image_format_hint(src)))
+        except Exception as e:
+            logger.error(f"Error procesando imagen base64: {e}")
+
+    def handle_starttag(self, tag, attrs):
+        if self._in_qr:
+            return
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+            return
+        if tag == "div" and attrs and attrs[0][0] == "id" and (attrs[0][1] or "").startswith("qr-"):
+            self._start_qr(attrs[0][1])
+            return
+        if tag == "img":
+            self._start_img(dict(attrs))
+            return
+        if tag == "br":
+            self._flush()
+            return
+        if tag == "hr":
+            self._flush()
+            self.blocks.append(("left", "-" * self.chars_per_line))
+            return
+        if tag in ("td", "th"):
+            if self._cells:
+                self._parts.append(" | ")
+            self._cells += 1
+        if tag in _BLOCK_TAGS or tag in _PARAGRAPH_TAGS:
+            self._flush()
+        if tag == "tr":
+            self._cells = 0
+        elif tag == "li":
+            self._parts.append("* ")
+        if tag in _VOID_TAGS:
+            return
+
+        # Alineación propia (style, atributo align o <center>) o la del padre
+        attrs = dict(attrs)
+        align_match = _RE_TEXT_ALIGN.search(attrs.get("style") or "")
+        if align_match:
+            align = align_match.group(1)
+        elif attrs.get("align") in ("left", "center", "right"):
+            align = attrs["align"]
+        elif tag == "center":
+            align = "center"
+        else:
+            align = self._stack[-1][1]
+        self._stack.append((tag, align))
+
+    def handle_endtag(self, tag):
+        if self._in_qr:
+            self._in_qr = tag != "div"
+            return
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+            return
+        if tag in _BLOCK_TAGS or tag in _PARAGRAPH_TAGS:
+            self._flush()
+        if tag in _PARAGRAPH_TAGS:
+            self._blank()
+        # Cerrar hasta la etiqueta correspondiente, tolerando HTML mal cerrado
+        for i in range(len(self._stack) - 1, 0, -1):
+            if self._stack[i][0] == tag:
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        if not self._skip and not self._in_qr:
+            self._parts.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+        while self.blocks and self.blocks[-1][1] == "":
+            self.blocks.pop()
+
+
+# Caché LRU opcional (config "cache" -> "ticket_lines") de líneas ya convertidas, para
+# plantillas que se repiten; con tickets siempre distintos solo añadiría el hash
+TICKET_LINES_CACHE_SIZE = 128
+_ticket_lines_cache = OrderedDict()
+_ticket_lines_cache_lock = threading.Lock()
+
+def html_to_printer_commands(html_content: str, paper_size: str, images: Optional[list] = None):
+    """
+    Convertir HTML a líneas de ticket [(alineación, texto)] ya ajustadas al ancho del papel;
+    si se indica, los QR y las imágenes base64 se agregan a images en la misma pasada
+    """
+    # Los marcadores [IMAGE_n] cuentan desde el inicio de images: solo se cachea si llega vacía
+    if images or not config.get("cache", {}).get("ticket_lines", False):
+        return _html_to_printer_commands(html_content, paper_size, images)
+
+    # Los QR llevan la fecha del día, así que también forma parte de la clave
+    key = (
+        hashlib.blake2b(html_content.encode("utf-8"), digest_size=16).digest(),
+        paper_size, images is not None, datetime.date.today(),
+    )
+    with _ticket_lines_cache_lock:
+        cached = _ticket_lines_cache.get(key)
+        if cached is not None:
+            _ticket_lines_cache.move_to_end(key)
+    if cached is None:
+        found = [] if images is not None else None
+        cached = (_html_to_printer_commands(html_content, paper_size, found), found or [])
+        with _ticket_lines_cache_lock:
+            _ticket_lines_cache[key] = cached
+            if len(_ticket_lines_cache) > TICKET_LINES_CACHE_SIZE:
+                _ticket_lines_cache.popitem(last=False)
+
+    lines, found = cached
+    if images is not None:
+        images.extend(found)
+    return lines
+
+def _html_to_printer_commands(html_content: str, paper_size: str, images: Optional[list] = None):
     try:
         # Configuración de papel
         paper_config = config["paper_sizes"][paper_size]
         chars_per_line = paper_config["chars_per_line"]
-        
-        # Procesar códigos QR en el HTML antes de convertir a texto
-        processed_html = process_qr_codes_in_html(html_content)
-
-        # Marcar bloques centrados antes de convertir a texto plano
-        def mark_centered_blocks(html):
-            def replacer(match):
-                tag = match.group(1)
-                style = match.group(2)
-                content = match.group(3)
-                if 'text-align:center' in style.replace(' ', ''):
-                    return f'<{tag} style="{style}">[CENTER]{content}[/CENTER]</{tag}>'
-                    # return f'<{tag} style="{style}">{content}</{tag}>'
-                elif 'align="center"' in style.replace(' ', ''):
-                    return f'<{tag} style="{style}">[CENTER]{content}[/CENTER]</{tag}>'
-                return match.group(0)
-            pattern = r'<(div|p)[^>]*style\s*=\s*"([^"]+)"[^>]*>(.*?)</\1>'
-            return re.sub(pattern, replacer, html, flags=re.DOTALL)
-
-        marked_html = mark_centered_blocks(processed_html)
-
-        # Convertir HTML a texto plano usando html2text
-        h = html2text.HTML2Text()
-        h.ignore_links = True
-        h.ignore_images = False  # Permitir imágenes para QR
-        h.body_width = chars_per_line
-        h.unicode_snob = True
-        text_content = h.handle(marked_html)
-        # print(f"{text_content}")
-        # Procesar el texto para formato de ticket
-        lines = text_content.split('\n')
-        processed_lines = []
-
-        for line in lines:
-            print(f"Procesando línea: {line}")
-            # Limpiar líneas vacías múltiples
-            if line.strip() == '':
-                print(f"if Procesando línea: {line}")
-                if not processed_lines or processed_lines[-1] != '':
-                    processed_lines.append('')
-            
-            # Si la línea contiene '[CENTER]' o '[/CENTER]', reemplazar y agregar los marcadores de alineación
-            elif '[CENTER]' in line:
-                new_line = line.replace('[CENTER]', '[ALIGN_CENTER]')
-                processed_lines.append(new_line)
-            elif '[/CENTER]' in line:
-                new_line = line.replace('[/CENTER]', '[/ALIGN_CENTER]')
-                processed_lines.append(new_line)
+        wrapper = _get_wrapper(chars_per_line)
+
+        # Sin etiquetas ni entidades el parser solo colapsaría los espacios
+        if _is_plain_text(html_content):
+            text = " ".join(html_content.split()).translate(_TEXT_TRANSLATION)
+            return [("left", line) for line in wrapper.wrap(text)]
+
+        parser = _TicketTextParser(chars_per_line, html_content, images)
+        parser.feed(html_content)
+        parser.close()
+
+        lines = []
+        for align, text in parser.blocks:
+            if text:
+                text = text.translate(_TEXT_TRANSLATION)
+                lines.extend((align, line) for line in wrapper.wrap(text))
             else:
-                print(f"else Procesando línea: {line}")
-                # Si la línea está marcada como centrada
-                if '[CENTER]' in line and '[/CENTER]' in line:
-                    centered_text = line.replace('[CENTER]', '').replace('[/CENTER]', '').strip()
-                    processed_lines.append(f'[ALIGN_CENTER]{centered_text}[/ALIGN_CENTER]')
-                else:
-                    # Ajustar línea si es muy larga
-                    if len(line) > chars_per_line:
-                        words = line.split()
-                        current_line = ""
-                        for word in words:
-                            if len(current_line + " " + word) <= chars_per_line:
-                                current_line += (" " + word) if current_line else word
-                            else:
-                                if current_line:
-                                    processed_lines.append(current_line)
-                                current_line = word
-                        if current_line:
-                            processed_lines.append(current_line)
-                    else:
-                        processed_lines.append(line)
-
-        return '\n'.join(processed_lines)
-        
+                lines.append((align, ""))
+        return lines
+
     except Exception as e:
         logger.error(f"Error al procesar HTML: {e}")
-        return html_content
-    
-    return html_content
+        return [("left", line) for line in str(html_content).split('\n')]
+
+def print_text_lines(printer, lines, images=None):
+    """
+    Imprimir líneas (alineación, texto) o texto plano línea por línea;
+    los marcadores [IMAGE_n] se imprimen como imagen
+    """
+    if isinstance(lines, str):
+        # Texto plano: un solo printer.text con las líneas en blanco normalizadas
+        # en lugar de una llamada (y una codificación) por línea
+        printer.text("".join(line + '\n' if line and not line.isspace() else '\n' for line in lines.split('\n')))
+        return
+    # Las líneas seguidas con la misma alineación salen en un único printer.text
+    text = printer.text
+    pending = []
+    current_align = "left"
+    for align, line in lines:
+        if align != current_align:
+            if pending:
+                text("".join(pending))
+                pending.clear()
+            printer.set(align=align)
+            current_align = align
+        if images and '[IMAGE_' in line:
+            # split con grupo alterna texto e índice de imagen
+            parts = _RE_IMAGE_MARKER.split(line)
+            for i, part in enumerate(parts):
+                if i % 2:
+                    if pending:
+                        text("".join(pending))
+                        pending.clear()
+                    print_raster_image(printer, images[int(part)])
+                else:
+                    part = part.strip()
+                    if part:
+                        pending.append(part + '\n')
+        elif line and not line.isspace():
+            pending.append(line + '\n')
+        else:
+            pending.append('\n')
+    if pending:
+        text("".join(pending))
+    if current_align != "left":
+        printer.set(align="left")
 
 def generate_qr_image(data: str, size: tuple = (100, 100)):
     """Generar imagen QR desde texto"""
@@ -522,131 +1073,231 @@ def generate_qr_image(data: str, size: tuple = (100, 100)):
         )
         qr.add_data(data)
         qr.make(fit=True)
-        
-        # Crear imagen QR
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        qr_img = qr_img.resize(size, Image.Resampling.LANCZOS)
-        
+
+        # Elegir el tamaño de módulo más cercano al destino para no generar
+        # una imagen grande que luego haya que reducir
+        border = qr.border
+        total_modules = qr.modules_count + 2 * border
+        box_size = max(1, min(size) // total_modules)
+
+        # Crear imagen QR: la matriz (1 píxel por módulo, con el margen) se arma como
+        # bytes y Pillow la amplía en C, en lugar de dibujar un rectángulo por módulo
+        pad = b"\xff" * border
+        rows = b"".join(pad + bytes(0 if module else 255 for module in row) + pad for row in qr.modules)
+        blank = b"\xff" * (total_modules * border)
+        qr_img = Image.frombytes("L", (total_modules, total_modules), blank + rows + blank)
+        qr_img = qr_img.convert("1", dither=Image.Dither.NONE)
+        qr_img = qr_img.resize((total_modules * box_size,) * 2, Image.Resampling.NEAREST)
+        if qr_img.size != tuple(size):
+            # En modo 1 bit Pillow siempre usa vecino más cercano
+            qr_img = qr_img.resize(size, Image.Resampling.NEAREST)
+
         return qr_img
     except Exception as e:
         logger.error(f"Error al generar QR: {e}")
         return None
 
+def qr_to_png(qr_image):
+    """Codificar la imagen QR como PNG"""
+    buffered = BytesIO()
+    qr_image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
 def qr_to_base64(qr_image):
     """Convertir imagen QR a base64 para HTML"""
     try:
-        buffered = BytesIO()
-        qr_image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        img_str = base64.b64encode(qr_to_png(qr_image)).decode()
         return f"data:image/png;base64,{img_str}"
     except Exception as e:
         logger.error(f"Error al convertir QR a base64: {e}")
         return None
 
-def extract_base64_images_from_html(html_content: str):
-    """Extraer imágenes base64 del HTML y convertirlas para impresión"""
-    import re
-    
-    images = []
-    # Patrón para encontrar imágenes base64 en el HTML
-    pattern = r'<img[^>]*src="data:image/[^;]+;base64,([^"]+)"[^>]*>'
-    
-    matches = re.finditer(pattern, html_content)
-    for match in matches:
-        try:
-            base64_data = match.group(1)
-            # Decodificar base64
-            image_bytes = base64.b64decode(base64_data)
-            image_stream = BytesIO(image_bytes)
-            
-            # Abrir imagen con PIL
-            img = Image.open(image_stream)
-            
-            # Crear objeto EscposImage
-            escpos_img = EscposImage(img)
-            # Guardar también la imagen PIL original para compatibilidad
-            escpos_img.pil_image = img
-            images.append(escpos_img)
-            
-            logger.info(f"Imagen base64 procesada correctamente: {len(image_bytes)} bytes")
-            
-        except Exception as e:
-            logger.error(f"Error procesando imagen base64: {e}")
-            continue
-    
-    return images
+# Caché LRU de QR ya codificados como PNG: los mismos datos y tamaño dan el mismo PNG
+QR_CACHE_SIZE = 128
+_qr_cache = OrderedDict()
+_qr_cache_lock = threading.Lock()
+
+def qr_png(data: str, size: int):
+    """PNG del QR de data a size x size px; None si no se pudo generar"""
+    key = (data, size)
+    png = _cached_qr_png(key)
+    if png is None:
+        png = _store_qr(key, render_qr(data, size))
+    return png
+
+# Generaciones de QR en curso, por (data, size)
+_qr_inflight = {}
+
+async def qr_png_async(data: str, size: int):
+    """Como qr_png, pero generando en el pool de procesos para no retener el GIL del event loop"""
+    key = (data, size)
+    png = _cached_qr_png(key)
+    if png is None:
+        # Peticiones simultáneas del mismo QR esperan a la misma generación.
+        # Todo ocurre en el event loop, así que el dict no necesita lock
+        task = _qr_inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(_render_and_store_qr(key))
+            _qr_inflight[key] = task
+            task.add_done_callback(lambda _: _qr_inflight.pop(key, None))
+        # shield: si un cliente se desconecta no se cancela la generación de los demás
+        png = await asyncio.shield(task)
+    return png
+
+async def _render_and_store_qr(key):
+    data, size = key
+    try:
+        loop = asyncio.get_running_loop()
+        rendered = await loop.run_in_executor(get_qr_pool(), render_qr, data, size)
+    except Exception as e:
+        logger.warning(f"Pool de QR no disponible, generando en un hilo: {e}")
+        rendered = await asyncio.to_thread(render_qr, data, size)
+    return _store_qr(key, rendered)
+
+def render_qr(data: str, size: int):
+    """
+    Generar el QR como (PNG, imagen de 1 bit); None si falla.
+    Está a nivel de módulo para que el pool de procesos pueda ejecutarla
+    """
+    qr_image = generate_qr_image(data, (size, size))
+    if qr_image is None:
+        return None
+    try:
+        return qr_to_png(qr_image), to_thermal_bitmap(qr_image)
+    except Exception as e:
+        logger.error(f"Error al convertir QR a PNG: {e}")
+        return None
+
+def _cached_qr_png(key):
+    with _qr_cache_lock:
+        png = _qr_cache.get(key)
+        if png is not None:
+            _qr_cache.move_to_end(key)
+        return png
+
+def _store_qr(key, rendered):
+    """Guardar un resultado de render_qr en las cachés y devolver el PNG"""
+    if rendered is None:
+        return None
+    png, bitmap = rendered
+    # Un QR recién generado suele imprimirse enseguida (testImagePrint): se deja ya
+    # decodificado, con la clave que calculará decode_base64_image para su data URI
+    b64_key = (hashlib.sha1(base64.b64encode(png)).digest(), None, None)
+    remember_decoded_image(b64_key, bitmap)
+    with _qr_cache_lock:
+        _qr_cache[key] = png
+        if len(_qr_cache) > QR_CACHE_SIZE:
+            _qr_cache.popitem(last=False)
+    return png
+
+# qrcode es Python puro y retiene el GIL: con varias peticiones a la vez los QR
+# se generan en procesos aparte. Se crea al primer uso
+_qr_pool = None
+_qr_pool_lock = threading.Lock()
+
+def get_qr_pool():
+    global _qr_pool
+    with _qr_pool_lock:
+        if _qr_pool is None:
+            _qr_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _qr_pool
+
+def shutdown_qr_pool():
+    """Cerrar el pool de QR para que no queden procesos al apagar o recargar"""
+    global _qr_pool
+    with _qr_pool_lock:
+        pool, _qr_pool = _qr_pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+def qr_etag(data: str, size: int):
+    """ETag del QR de data a size px: el PNG depende sólo de estos dos valores"""
+    digest = hashlib.blake2b(f"{size}\0{data}".encode("utf-8"), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str):
+    """True si la cabecera If-None-Match incluye el ETag (o es *)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+def png_data_uri(png):
+    return "data:image/png;base64," + base64.b64encode(png).decode() if png is not None else None
+
+def qr_data_uri(data: str, size: int):
+    """Data URI PNG del QR de data a size x size px; None si no se pudo generar"""
+    return png_data_uri(qr_png(data, size))
+
+async def qr_data_uri_async(data: str, size: int):
+    """Como qr_data_uri, generando en el pool de procesos"""
+    return png_data_uri(await qr_png_async(data, size))
+
+def _decode_div_image(i, match):
+    """Decodificar la imagen base64 de un <div><img></div> encontrado; None si falla"""
+    try:
+        div_attrs = match.group(1)
+        img_attrs = match.group(3) + match.group(5)
+        full_base64_string = match.group(4)
+        # Extraer estilos inline del div
+        style_match = _RE_STYLE.search(div_attrs)
+        div_style = style_match.group(1) if style_match else ""
+        # Extraer estilos inline del img
+        img_style_match = _RE_STYLE.search(img_attrs)
+        img_style = img_style_match.group(1) if img_style_match else ""
+
+        # Buscar width/height en el style del img
+        width, height = style_dimensions(img_style)
+
+        # Extraer solo la parte base64 (sin el prefijo data:image/...)
+        base64_data = full_base64_string[full_base64_string.index(',') + 1:]
+        # Decodificar y redimensionar si se especifica width/height
+        img = decode_base64_image(base64_data, width, height, image_format_hint(full_base64_string))
+
+        logger.info(f"Imagen base64 detectada #{i}: {img.size[0]}x{img.size[1]} px, estilos div: {div_style}, estilos img: {img_style}")
+        return {
+            'pil_image': img,
+            'base64_string': full_base64_string,
+            'position': i,
+            'size': img.size,
+            'div_style': div_style,
+            'img_style': img_style,
+            'width': width,
+            'height': height
+        }
+    except Exception as e:
+        logger.error(f"Error procesando imagen base64 #{i}: {e}")
+        return None
 
 def detect_and_process_base64_images(html_content: str):
     """Detectar imágenes base64 en HTML y procesarlas para impresión"""
-    import re
-    
-    # Patrón para detectar div con imagen base64 y extraer estilos
-    div_img_pattern = r'<div([^>]*)>(\s*)<img([^>]*)src="(data:image/[^;]+;base64,[^"]+)"([^>]*)>(.*?)</div>'
-    images_found = []
-    image_replacements = {}
-    processed_html = html_content
-    print(f"{processed_html}")
+    print(f"{html_content}")
+    if _is_plain_text(html_content):
+        return html_content, []
 
     # Buscar divs con imágenes base64
-    for i, match in enumerate(re.finditer(div_img_pattern, html_content, re.DOTALL)):
-        try:
-            div_attrs = match.group(1)
-            img_attrs = match.group(3) + match.group(5)
-            full_base64_string = match.group(4)
-            # Extraer estilos inline del div
-            style_match = re.search(r'style\s*=\s*"([^"]+)"', div_attrs)
-            div_style = style_match.group(1) if style_match else ""
-            # Extraer estilos inline del img
-            img_style_match = re.search(r'style\s*=\s*"([^"]+)"', img_attrs)
-            img_style = img_style_match.group(1) if img_style_match else ""
-
-            # Buscar width/height en el style del img
-            width = None
-            height = None
-            if img_style:
-                width_match = re.search(r'width\s*:\s*(\d+)px', img_style)
-                height_match = re.search(r'height\s*:\s*(\d+)px', img_style)
-                if width_match:
-                    width = int(width_match.group(1))
-                if height_match:
-                    height = int(height_match.group(1))
-
-            # Extraer solo la parte base64 (sin el prefijo data:image/...)
-            base64_data = full_base64_string.split(',')[1]
-            image_bytes = base64.b64decode(base64_data)
-            image_stream = BytesIO(image_bytes)
-            img = Image.open(image_stream)
-
-            # Redimensionar si se especifica width/height
-            if width or height:
-                orig_w, orig_h = img.size
-                new_w = width if width else orig_w
-                new_h = height if height else orig_h
-                img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-
-            image_info = {
-                'pil_image': img,
-                'base64_string': full_base64_string,
-                'position': i,
-                'size': img.size,
-                'div_style': div_style,
-                'img_style': img_style,
-                'width': width,
-                'height': height
-            }
-            images_found.append(image_info)
+    matches = list(_RE_DIV_IMG.finditer(html_content))
+    if len(matches) > 1:
+        # Pillow libera el GIL al decodificar, así que los hilos sí trabajan en paralelo
+        with ThreadPoolExecutor(max_workers=min(8, len(matches))) as executor:
+            results = list(executor.map(_decode_div_image, range(len(matches)), matches))
+    else:
+        results = [_decode_div_image(i, match) for i, match in enumerate(matches)]
 
-            # Crear marcador único para reemplazar en el HTML
-            marker = f"[IMG_PLACEHOLDER_{i}]"
-            image_replacements[match.group(0)] = marker
-            logger.info(f"Imagen base64 detectada #{i}: {img.size[0]}x{img.size[1]} px, estilos div: {div_style}, estilos img: {img_style}")
-        except Exception as e:
-            logger.error(f"Error procesando imagen base64 #{i}: {e}")
+    # Reemplazar los divs con imágenes por marcadores únicos en una sola pasada,
+    # pegando los trozos de HTML entre las posiciones de cada coincidencia
+    images_found = []
+    parts = []
+    last = 0
+    for match, image_info in zip(matches, results):
+        if image_info is None:
             continue
-
-    # Reemplazar los divs con imágenes en el HTML por marcadores
-    for div_html, marker in image_replacements.items():
-        processed_html = processed_html.replace(div_html, marker)
+        images_found.append(image_info)
+        parts.append(html_content[last:match.start()])
+        parts.append(f"[IMG_PLACEHOLDER_{image_info['position']}]")
+        last = match.end()
+    parts.append(html_content[last:])
+    processed_html = "".join(parts)
 
     return processed_html, images_found
 
@@ -668,7 +1319,7 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #     for line in lines:
     #         # Buscar marcadores de imagen en la línea
     #         if '[IMG_PLACEHOLDER_' in line:
-    #             marker_match = re.search(r'\[IMG_PLACEHOLDER_(\d+)\]', line)
+    #             marker_match = _RE_PLACEHOLDER.search(line)
     #             if marker_match:
     #                 placeholder_num = int(marker_match.group(1))
     #                 matching_image = None
@@ -694,12 +1345,12 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #                             align = 'left'
     #                     if 'margin-top:' in style:
     #                         try:
-    #                             margin_top = int(re.search(r'margin-top:\s*(\d+)', style).group(1))
+    #                             margin_top = int(_RE_MARGIN_TOP.search(style).group(1))
     #                         except:
     #                             margin_top = 0
     #                     if 'margin-bottom:' in style:
     #                         try:
-    #                             margin_bottom = int(re.search(r'margin-bottom:\s*(\d+)', style).group(1))
+    #                             margin_bottom = int(_RE_MARGIN_BOTTOM.search(style).group(1))
     #                         except:
     #                             margin_bottom = 0
     #                     # Aplicar alineación
@@ -716,13 +1367,13 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #                     if text_after:
     #                         printer_instance.text(text_after + '\n')
     #                 else:
-    #                     clean_line = re.sub(r'\[IMG_PLACEHOLDER_\d+\]', '[IMAGEN]', line)
+    #                     clean_line = _RE_PLACEHOLDER.sub('[IMAGEN]', line)
     #                     if clean_line.strip():
     #                         printer_instance.text(clean_line + '\n')
     #                     else:
     #                         printer_instance.text('\n')
     #             else:
-    #                 clean_line = re.sub(r'\[IMG_PLACEHOLDER_\d+\]', '[IMAGEN]', line)
+    #                 clean_line = _RE_PLACEHOLDER.sub('[IMAGEN]', line)
     #                 if clean_line.strip():
     #                     printer_instance.text(clean_line + '\n')
     #                 else:
@@ -735,7 +1386,7 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #             printer_instance.set(align='left')
     #         else:
     #             # Buscar estilos inline en la línea
-    #             style_match = style_pattern.search(line)
+    #             style_match = _RE_INLINE_STYLE.search(line)
     #             if style_match:
     #                 tag = style_match.group(1)
     #                 attrs = style_match.group(2)
@@ -756,7 +1407,7 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #                     elif 'left' in style:
     #                         align = 'left'
     #                 # Font size
-    #                 font_size_match = re.search(r'font-size:\s*(\d+)px', style)
+    #                 font_size_match = _RE_FONT_SIZE.search(style)
     #                 if font_size_match:
     #                     font_size = int(font_size_match.group(1))
     #                 # Font weight
@@ -764,33 +1415,25 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #                     if 'bold' in style:
     #                         font_weight = 'bold'
     #                 # Font family
-    #                 font_family_match = re.search(r'font-family:\s*([^;]+);?', style)
+    #                 font_family_match = _RE_FONT_FAMILY.search(style)
     #                 if font_family_match:
     #                     font_family = font_family_match.group(1).strip()
     #                 # Color
-    #                 color_match = re.search(r'color:\s*([^;]+);?', style)
+    #                 color_match = _RE_COLOR.search(style)
     #                 if color_match:
     #                     color = color_match.group(1).strip()
-    #                 # Aplicar estilos compatibles con la impresora
-    #                 if align:
-    #                     printer_instance.set(align=align)
-    #                 if font_weight == 'bold':
-    #                     printer_instance.set(bold=True)
-    #                 if font_size:
-    #                     # Ajustar tamaño de fuente (solo 1=normal, 2=doble en la mayoría de impresoras)
-    #                     if font_size >= 16:
-    #                         printer_instance.set(width=2, height=2)
-    #                     elif font_size >= 12:
-    #                         printer_instance.set(width=1, height=1)
+    #                 # Aplicar estilos compatibles con la impresora con los comandos ya
+    #                 # precalculados, en una sola escritura (sin custom_size python-escpos
+    #                 # no emite el tamaño de fuente, así que font_size no cambia nada)
+    #                 style_on = (ALIGN_CMD[align] if align else b"") + (ESC_BOLD_ON if font_weight == 'bold' else b"")
+    #                 if style_on:
+    #                     printer_instance._raw(style_on)
     #                 # Imprimir el texto con estilos
     #                 printer_instance.text(inner_text + '\n')
     #                 # Restaurar estilos
-    #                 if align:
-    #                     printer_instance.set(align='left')
-    #                 if font_weight == 'bold':
-    #                     printer_instance.set(bold=False)
-    #                 if font_size:
-    #                     printer_instance.set(width=1, height=1)
+    #                 style_off = (ALIGN_CMD['left'] if align else b"") + (ESC_BOLD_OFF if font_weight == 'bold' else b"")
+    #                 if style_off:
+    #                     printer_instance._raw(style_off)
     #             else:
     #                 if line.strip():
     #                     printer_instance.text(line + '\n')
@@ -811,6 +1454,72 @@ def print_content_with_images(content, images, printer_instance, paper_size: str
     #     logger.error(f"Error imprimiendo contenido con imágenes: {e}")
     return False
 
+def render_ticket(content, paper_size: str):
+    """Generar en memoria los bytes ESC/POS completos de un ticket (con avance y corte)"""
+    printer = Dummy()
+
+    # Configurar papel
+    printer.set(align='left', width=1, height=1, font='a')
+    
+    if isinstance(content, Image.Image):
+        # Si es una imagen PIL directa
+        escpos_img = EscposImage(content)
+        printer.image(escpos_img)
+    elif isinstance(content, str) and 'data:image' in content:
+        # Texto, QR e imágenes base64 en una sola pasada; las imágenes salen en su sitio
+        images = []
+        ticket_lines = html_to_printer_commands(content, paper_size, images)
+        if images:
+            logger.info(f"Detectadas {len(images)} imágenes en el HTML")
+        print_text_lines(printer, ticket_lines, images)
+    else:
+        # Imprimir texto normal línea por línea
+        print_text_lines(printer, content)
+    
+    printer.ln(2)  # Salto de línea adicional
+    printer.cut()
+    return printer.output
+
+# Conexiones USB abiertas que se reutilizan entre tickets; tras PRINTER_IDLE_TIMEOUT
+# segundos sin uso se reabren. Las de red no se reutilizan: si la impresora ya cerró
+# el socket, escribir en él no da error y el ticket se perdería sin aviso
+PRINTER_IDLE_TIMEOUT = 30.0
+_printer_handles = {}
+_printer_handles_lock = threading.Lock()
+
+def _close_quietly(printer):
+    try:
+        printer.close()
+    except Exception:
+        pass
+
+def send_to_printer(key, factory, data):
+    """
+    Escribir data en la conexión reutilizable `key`, abriéndola con factory() si hace falta;
+    si la conexión reutilizada falla se reintenta una vez con una nueva
+    """
+    with _printer_handles_lock:
+        now = time.monotonic()
+        entry = _printer_handles.pop(key, None)
+        if entry is not None:
+            printer, last_used = entry
+            if now - last_used <= PRINTER_IDLE_TIMEOUT:
+                try:
+                    printer._raw(data)
+                    _printer_handles[key] = (printer, now)
+                    return
+                except Exception as e:
+                    logger.warning(f"Conexión reutilizada a {key} falló, reabriendo: {e}")
+            _close_quietly(printer)
+
+        printer = factory()
+        try:
+            printer._raw(data)
+        except Exception:
+            _close_quietly(printer)
+            raise
+        _printer_handles[key] = (printer, now)
+
 def print_to_usb(content, paper_size: str):
     """Imprimir usando USB"""
     try:
@@ -818,59 +1527,9 @@ def print_to_usb(content, paper_size: str):
         vendor_id = int(usb_config["vendor_id"], 16)
         product_id = int(usb_config["product_id"], 16)
         
-        printer = Usb(vendor_id, product_id)
-        
-        # Configurar papel
-        printer.set(align='left', width=1, height=1, font='a')
-        
-        if isinstance(content, Image.Image):
-            # Si es una imagen PIL directa
-            escpos_img = EscposImage(content)
-            printer.image(escpos_img)
-        elif isinstance(content, str) and 'data:image' in content:
-            # Detectar y procesar imágenes base64 en HTML
-            processed_html, images = detect_and_process_base64_images(content)
-            
-            if images:
-                logger.info(f"Detectadas {len(images)} imágenes base64 en el HTML")
-                # Imprimir contenido con imágenes intercaladas
-                success = print_content_with_images(processed_html, images, printer, paper_size)
-                if not success:
-                    # Fallback: imprimir texto y luego imágenes
-                    text_content = html_to_printer_commands(processed_html, paper_size)
-                    lines = str(text_content).split('\n')
-                    for line in lines:
-                        if line.strip():
-                            printer.text(line + '\n')
-                        else:
-                            printer.text('\n')
-                    
-                    # Imprimir imágenes al final
-                    for img_info in images:
-                        printer.ln(1)
-                        printer.image(img_info['pil_image'])
-                        printer.ln(1)
-            else:
-                # No hay imágenes, procesar como HTML normal
-                text_content = html_to_printer_commands(content, paper_size)
-                lines = str(text_content).split('\n')
-                for line in lines:
-                    if line.strip():
-                        printer.text(line + '\n')
-                    else:
-                        printer.text('\n')
-        else:
-            # Imprimir texto normal línea por línea
-            lines = str(content).split('\n')
-            for line in lines:
-                if line.strip():
-                    printer.text(line + '\n')
-                else:
-                    printer.text('\n')
-        
-        printer.ln(2)  # Salto de línea adicional
-        printer.cut()
-        printer.close()
+        # Todo el ticket sale en una sola escritura USB en lugar de una por línea
+        send_to_printer(("usb", vendor_id, product_id), lambda: Usb(vendor_id, product_id),
+                        render_ticket(content, paper_size))
         return True, "Impresión USB exitosa"
         
     except USBNotFoundError:
@@ -886,59 +1545,14 @@ def print_to_network(content, paper_size: str):
         ip = network_config["ip"]
         port = network_config.get("port", 9100)
         
+        # Todo el ticket sale en una sola escritura TCP en lugar de una por línea,
+        # con una conexión nueva por ticket (ver PRINTER_IDLE_TIMEOUT)
+        data = render_ticket(content, paper_size)
         printer = Network(ip, port)
-        
-        # Configurar papel
-        printer.set(align='left', width=1, height=1, font='a')
-        
-        if isinstance(content, Image.Image):
-            # Si es una imagen PIL directa
-            escpos_img = EscposImage(content)
-            printer.image(escpos_img)
-        elif isinstance(content, str) and 'data:image' in content:
-            # Detectar y procesar imágenes base64 en HTML
-            processed_html, images = detect_and_process_base64_images(content)
-            
-            if images:
-                logger.info(f"Detectadas {len(images)} imágenes base64 en el HTML")
-                # Imprimir contenido con imágenes intercaladas
-                success = print_content_with_images(processed_html, images, printer, paper_size)
-                if not success:
-                    # Fallback: imprimir texto y luego imágenes
-                    text_content = html_to_printer_commands(processed_html, paper_size)
-                    lines = str(text_content).split('\n')
-                    for line in lines:
-                        if line.strip():
-                            printer.text(line + '\n')
-                        else:
-                            printer.text('\n')
-                    
-                    # Imprimir imágenes al final
-                    for img_info in images:
-                        printer.ln(1)
-                        printer.image(img_info['pil_image'])
-                        printer.ln(1)
-            else:
-                # No hay imágenes, procesar como HTML normal
-                text_content = html_to_printer_commands(content, paper_size)
-                lines = str(text_content).split('\n')
-                for line in lines:
-                    if line.strip():
-                        printer.text(line + '\n')
-                    else:
-                        printer.text('\n')
-        else:
-            # Imprimir texto normal línea por línea
-            lines = str(content).split('\n')
-            for line in lines:
-                if line.strip():
-                    printer.text(line + '\n')
-                else:
-                    printer.text('\n')
-        
-        printer.ln(2)  # Salto de línea adicional
-        printer.cut()
-        printer.close()
+        try:
+            printer._raw(data)
+        finally:
+            _close_quietly(printer)
         return True, "Impresión de red exitosa"
         
     except Exception as e:
@@ -951,10 +1565,8 @@ def print_to_system_printer(content, paper_size: str, printer_name: str):
         return False, "win32print no está disponible"
     
     try:
-        # Crear archivo temporal con el contenido
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as temp_file:
-            temp_file.write(str(content))
-            temp_file_path = temp_file.name
+        # El contenido ya está en memoria: se envía directo sin pasar por un archivo temporal
+        payload = str(content).encode('utf-8')
         
         # Imprimir usando win32print
         try:
@@ -968,49 +1580,29 @@ def print_to_system_printer(content, paper_size: str, printer_name: str):
             # Iniciar página
             win32print.StartPagePrinter(printer_handle)
             
-            # Leer contenido del archivo
-            with open(temp_file_path, 'r', encoding='utf-8') as f:
-                content_str = f.read()
-            
             # Escribir datos a la impresora
-            win32print.WritePrinter(printer_handle, content_str.encode('utf-8'))
+            win32print.WritePrinter(printer_handle, payload)
             
             # Finalizar página y documento
             win32print.EndPagePrinter(printer_handle)
             win32print.EndDocPrinter(printer_handle)
             win32print.ClosePrinter(printer_handle)
             
-            # Limpiar archivo temporal
-            import os
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
-            
             return True, f"Impresión exitosa en {printer_name}"
             
         except Exception as e:
             logger.error(f"Error win32print: {e}")
-            # Fallback: usar comando print de Windows
+            # Fallback: escribir directo al dispositivo PRN (antes 'cmd /c type archivo > PRN',
+            # que además del archivo temporal lanzaba un proceso por ticket)
             try:
-                import subprocess
-                import os
-                
-                # Usar el comando print de Windows
-                result = subprocess.run([
-                    'cmd', '/c', f'type "{temp_file_path}" > PRN'
-                ], capture_output=True, text=True, check=False)
-                
-                # Limpiar archivo temporal
+                handle = win32file.CreateFile(
+                    "PRN", win32file.GENERIC_WRITE, 0, None, win32file.OPEN_EXISTING, 0, None
+                )
                 try:
-                    os.unlink(temp_file_path)
-                except:
-                    pass
-                
-                if result.returncode == 0:
-                    return True, f"Documento enviado a imprimir en {printer_name}"
-                else:
-                    return False, f"Error en comando print: {result.stderr}"
+                    win32file.WriteFile(handle, payload)
+                finally:
+                    win32file.CloseHandle(handle)
+                return True, f"Documento enviado a imprimir en {printer_name}"
             except Exception as e2:
                 return False, f"Error en impresión del sistema: {str(e2)}"
         
@@ -1024,20 +1616,20 @@ def print_raw_to_printer(content, printer_name: str):
         return False, "win32print no está disponible para impresión RAW"
     
     try:
-        # Para impresoras térmicas, agregar comandos ESC/POS básicos
-        esc_init = b"\x1B\x40"  # Initialize printer
-        content_bytes = str(content).encode('utf-8', errors='ignore')
-        esc_feed = b"\x1B\x64\x02"  # Feed 2 lines
-        esc_cut = b"\x1D\x56\x41\x10"  # Cut paper
-        
-        full_content = esc_init + content_bytes + esc_feed + esc_cut
+        # Para impresoras térmicas, agregar comandos ESC/POS básicos;
+        # se arma en un único buffer en lugar de concatenar bytes copiando el contenido
+        if not isinstance(content, str):
+            content = str(content)
+        full_content = bytearray(ESC_INIT)
+        full_content += content.encode('utf-8', errors='ignore')
+        full_content += ESC_FEED2_CUT
         
         # Enviar a impresora
         printer_handle = win32print.OpenPrinter(printer_name)
         job_info = ("Ticket POS RAW", None, "RAW")
         job_id = win32print.StartDocPrinter(printer_handle, 1, job_info)
         win32print.StartPagePrinter(printer_handle)
-        win32print.WritePrinter(printer_handle, full_content)
+        win32print.WritePrinter(printer_handle, bytes(full_content))
         win32print.EndPagePrinter(printer_handle)
         win32print.EndDocPrinter(printer_handle)
         win32print.ClosePrinter(printer_handle)
@@ -1054,33 +1646,26 @@ def print_with_escpos_system(content, printer_name: str):
     try:
         from escpos import printer
         
-        # Intentar usar Win32Raw si está disponible
+        # Texto, QR e imágenes base64 en una sola pasada del HTML; el fallback reutiliza el resultado
+        # (y también la comprobación, que recorre todo el HTML)
+        is_html_with_images = isinstance(content, str) and 'data:image' in content
+        if is_html_with_images:
+            images = []
+            ticket_lines = html_to_printer_commands(content, "80mm", images)
+            if images:
+                logger.info(f"Detectadas {len(images)} imágenes base64 para impresora del sistema")
+        
+        # Si win32print está disponible, generar en memoria y enviar en una sola escritura
         if WIN32_AVAILABLE:
             try:
-                p = printer.Win32Raw(printer_name)
+                p = printer.Dummy()
                 
                 if isinstance(content, Image.Image):
                     # Si es una imagen PIL directa, pasarla directamente
                     p.image(content)
-                elif isinstance(content, str) and 'data:image' in content:
-                    # Detectar y procesar imágenes base64 en HTML
-                    processed_html, images = detect_and_process_base64_images(content)
-                    
-                    if images:
-                        logger.info(f"Detectadas {len(images)} imágenes base64 para impresora del sistema")
-                        # Imprimir contenido con imágenes intercaladas usando Win32Raw
-                        print("Imprimir contenido con imágenes intercaladas usando Win32Raw")
-                        success = print_content_with_images(processed_html, images, p, "80mm")
-                        if not success:
-                            # Fallback: imprimir texto y luego imágenes
-                            p.text(str(processed_html))
-                            for img_info in images:
-                                p.ln(1)
-                                p.image(img_info['pil_image'])
-                                p.ln(1)
-                    else:
-                        # No hay imágenes, imprimir texto normal
-                        p.text(str(content))
+                elif is_html_with_images:
+                    # Imprimir contenido con imágenes intercaladas en su sitio
+                    print_text_lines(p, ticket_lines, images)
                 else:
                     # Texto normal
                     # print(f"{content}")
@@ -1093,7 +1678,7 @@ def print_with_escpos_system(content, printer_name: str):
                 
                 # p.ln(2)
                 p.cut()
-                p.close()
+                write_raw_to_printer(printer_name, p.output)
                 print(f"Impresión ESCPOS exitosa en {printer_name}")
                 return True, f"Impresión ESCPOS exitosa en {printer_name}"
             except Exception as e:
@@ -1101,13 +1686,8 @@ def print_with_escpos_system(content, printer_name: str):
         
         # Fallback: usar Dummy printer para debug
         p = printer.Dummy()
-        if isinstance(content, str) and 'data:image' in content:
-            processed_html, images = detect_and_process_base64_images(content)
-            p.text(str(processed_html))
-            for img_info in images:
-                # Para Dummy printer, crear EscposImage
-                escpos_img = EscposImage(img_info['pil_image'])
-                p.image(escpos_img)
+        if is_html_with_images:
+            print_text_lines(p, ticket_lines, images)
         else:
             p.text(str(content))
         p.cut()
@@ -1121,9 +1701,8 @@ def print_with_escpos_system(content, printer_name: str):
         return False, f"Error en impresión ESCPOS: {str(e)}"
 
 # Endpoints de la API
-@app.get("/")
-async def root():
-    """Página principal con interfaz web"""
+def index_page_html():
+    """HTML de la página principal con interfaz web"""
     html_content = """
     <!DOCTYPE html>
     <html lang="es">
@@ -1131,7 +1710,7 @@ async def root():
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>PrintPOS API</title>
-        <script src="https://unpkg.com/qrcode@1.5.3/build/qrcode.min.js"></script>
+        <script src="__QRCODE_JS__"></script>
         <style>
             body {
                 font-family: Arial, sans-serif;
@@ -1407,7 +1986,7 @@ async def root():
                 displayResponse('printResponse', result.data || result.error, result.success);
             }
 
-            function loadExample(type) {
+            async function loadExample(type) {
                 console.log('Cargando ejemplo:', type);
                 
                 // Ejemplos base sin QR
@@ -1467,8 +2046,8 @@ async def root():
                 document.getElementById('htmlContent').value = baseExamples[type];
                 console.log('Ejemplo base cargado. Ahora generando QR...');
                 
-                // Generar QR después de cargar
-                setTimeout(() => addQRToExample(type), 100);
+                // Generar QR después de cargar (la asignación anterior es síncrona, no hace falta esperar)
+                await addQRToExample(type);
             }
 
             async function addQRToExample(type) {
@@ -1492,9 +2071,6 @@ async def root():
                     console.log('Resultado:', result);
 
                     if (result.success && result.qr_code) {
-                        // Obtener HTML actual
-                        const currentHTML = document.getElementById('htmlContent').value;
-                        
                         // Crear HTML del QR muy simple
                         const qrHTML = `
     <p>================================</p>
@@ -1505,7 +2081,7 @@ async def root():
     <p style="text-align: center; font-size: 10px;">Escanea para verificar</p>`;
                         
                         // Agregar QR al HTML
-                        document.getElementById('htmlContent').value = currentHTML + qrHTML;
+                        appendToTextarea(document.getElementById('htmlContent'), qrHTML);
                         console.log('✅ QR agregado exitosamente');
                         
                     } else {
@@ -1567,23 +2143,10 @@ async def root():
                 }
 
                 if (qrData && elementId) {
-                    try {
-                        const response = await makeRequest('/generate_qr', {
-                            method: 'POST',
-                            body: JSON.stringify({
-                                data: qrData,
-                                size: size
-                            })
-                        });
-
-                        if (response.success && response.data && response.data.qr_code) {
-                            const element = document.getElementById(elementId);
-                            if (element) {
-                                element.innerHTML = `<img src="${response.data.qr_code}" alt="QR Code" style="width:${size}px;height:${size}px;">`;
-                            }
-                        }
-                    } catch (error) {
-                        console.error('Error generating server-side QR:', error);
+                    // El PNG se pide por URL: el navegador lo descarga sin JSON ni base64 y lo cachea
+                    const element = document.getElementById(elementId);
+                    if (element) {
+                        element.innerHTML = `<img src="/qr.png?data=${encodeURIComponent(qrData)}&size=${size}" alt="QR Code" style="width:${size}px;height:${size}px;">`;
                     }
                 }
             }
@@ -1623,7 +2186,16 @@ async def root():
                 }
             }
 
-            async function generateCustomQR() {
+            let customQRTimer = null;
+            let customQRController = null;
+
+            // Clics seguidos: sólo se genera el último y se cancela la petición anterior
+            function generateCustomQR() {
+                clearTimeout(customQRTimer);
+                customQRTimer = setTimeout(generateCustomQRNow, 150);
+            }
+
+            async function generateCustomQRNow() {
                 const qrData = document.getElementById('qrData').value.trim();
                 const resultDiv = document.getElementById('customQRResult');
                 
@@ -1635,6 +2207,12 @@ async def root():
                 // Mostrar indicador de carga
                 resultDiv.innerHTML = '<p>🔄 Generando QR...</p>';
 
+                if (customQRController) {
+                    customQRController.abort();
+                }
+                const controller = new AbortController();
+                customQRController = controller;
+
                 try {
                     // Siempre usar generación del servidor para QR personalizados
                     const response = await makeRequest('/generate_qr', {
@@ -1642,16 +2220,22 @@ async def root():
                         body: JSON.stringify({
                             data: qrData,
                             size: 120
-                        })
+                        }),
+                        signal: controller.signal
                     });
 
+                    // Una petición más nueva ya se encarga del resultado
+                    if (controller.signal.aborted) {
+                        return;
+                    }
+
                     if (response.success && response.data && response.data.qr_code) {
                         resultDiv.innerHTML = `
                             <div style="margin: 10px 0;">
                                 <p><strong>✅ QR Generado</strong></p>
                                 <img src="${response.data.qr_code}" alt="QR Code" style="max-width: 120px; border: 1px solid #ddd; display: block; margin: 10px auto;">
                                 <br>
-                                <button onclick="insertQRIntoHTML('${response.data.qr_code}')" style="margin-top: 10px; padding: 5px 10px;">📝 Insertar en HTML</button>
+                                <button data-qr="${escapeHTMLAttr(qrData)}" onclick="insertQRIntoHTML(this.dataset.qr)" style="margin-top: 10px; padding: 5px 10px;">📝 Insertar en HTML</button>
                             </div>
                         `;
                     } else {
@@ -1663,17 +2247,34 @@ async def root():
                 }
             }
 
-            function insertQRIntoHTML(qrBase64) {
+            // Agrega texto al final del textarea sin reasignar todo su contenido
+            function appendToTextarea(textarea, text) {
+                const end = textarea.value.length;
+                textarea.setRangeText(text, end, end, 'end');
+            }
+
+            function escapeHTMLAttr(text) {
+                return text.replace(/&/g, '&amp;').replace(/"/g, '&quot;').replace(/</g, '&lt;');
+            }
+
+            // QR como marcador: en el HTML sólo van los datos (data-value). La vista previa
+            // carga /qr.png, que el navegador cachea, y al imprimir se genera un QR ESC/POS nativo
+            function qrPlaceholderImg(qrData, size, style) {
+                const src = `/qr.png?data=${encodeURIComponent(qrData)}&size=${size}`;
+                return `<img data-type="qr" data-value="${escapeHTMLAttr(qrData)}" src="${escapeHTMLAttr(src)}" alt="QR Code" style="${style}">`;
+            }
+
+            function insertQRIntoHTML(qrData) {
                 const htmlContent = document.getElementById('htmlContent');
                 const qrHTML = `
     <div style="text-align: center; margin: 10px 0;">
         <p><strong>📱 Código QR</strong></p>
-        <img src="${qrBase64}" alt="QR Code" style="width: 100px; height: 100px;">
+        ${qrPlaceholderImg(qrData, 100, 'width: 100px; height: 100px;')}
         <p style="font-size: 10px;">Escanea para más información</p>
     </div>`;
                 
                 // Insertar QR al final del contenido actual
-                htmlContent.value += qrHTML;
+                appendToTextarea(htmlContent, qrHTML);
                 
                 // Mostrar mensaje de confirmación
                 document.getElementById('customQRResult').innerHTML += '<p style="color: green; margin-top: 10px;">✅ QR insertado en el HTML</p>';
@@ -1717,37 +2318,19 @@ async def root():
 
                 console.log('Agregando QR con datos:', qrData);
 
-                try {
-                    // Generar QR usando el servidor
-                    const response = await makeRequest('/generate_qr', {
-                        method: 'POST',
-                        body: JSON.stringify({
-                            data: qrData,
-                            size: 100
-                        })
-                    });
-
-                    if (response.success && response.data && response.data.qr_code) {
-                        // Crear sección QR
-                        const qrSection = `
+                // Crear sección QR (el QR se genera al previsualizar o imprimir)
+                const qrSection = `
     <div style="text-align: center; margin: 15px 0; padding: 10px; border: 1px solid #ddd;">
         <p><strong>📱 Código QR</strong></p>
-        <img src="${response.data.qr_code}" alt="QR Code" style="width:100px;height:100px;display:block;margin:10px auto;border:1px solid #ccc;">
+        ${qrPlaceholderImg(qrData, 100, 'width:100px;height:100px;display:block;margin:10px auto;border:1px solid #ccc;')}
         <p style="font-size: 10px;">Escanea para más información</p>
     </div>`;
-                        
-                        // Agregar QR al final del HTML actual
-                        document.getElementById('htmlContent').value = htmlContent + qrSection;
-                        
-                        alert('✅ QR agregado exitosamente al HTML');
-                        console.log('✅ QR agregado al HTML');
-                    } else {
-                        alert('❌ Error al generar QR: ' + (response.error || 'Error desconocido'));
-                    }
-                } catch (error) {
-                    console.error('Error agregando QR:', error);
-                    alert('❌ Error al agregar QR: ' + error.message);
-                }
+                
+                // Agregar QR al final del HTML actual
+                appendToTextarea(document.getElementById('htmlContent'), qrSection);
+                
+                alert('✅ QR agregado exitosamente al HTML');
+                console.log('✅ QR agregado al HTML');
             }
 
             async function testQRSimple() {
@@ -1843,22 +2426,35 @@ async def root():
             window.onload = function() {
                 listPrinters();
                 
-                // Verificar si QRCode se cargó correctamente
-                setTimeout(function() {
-                    if (typeof QRCode === 'undefined') {
-                        console.warn('QRCode library failed to load from CDN');
-                        document.getElementById('qrStatus').innerHTML = '⚠️ Librería QR no disponible - usando generación del servidor';
-                    } else {
-                        console.log('QRCode library loaded successfully');
-                        document.getElementById('qrStatus').innerHTML = '✅ Librería QR cargada correctamente';
-                    }
-                }, 1000);
+                // Verificar si QRCode se cargó correctamente: el script del <head> es
+                // síncrono, así que en onload ya se cargó o ya falló
+                if (typeof QRCode === 'undefined') {
+                    console.warn('QRCode library failed to load');
+                    document.getElementById('qrStatus').innerHTML = '⚠️ Librería QR no disponible - usando generación del servidor';
+                } else {
+                    console.log('QRCode library loaded successfully');
+                    document.getElementById('qrStatus').innerHTML = '✅ Librería QR cargada correctamente';
+                }
             };
         </script>
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+    return html_content
+
+# La página es estática: se codifica una sola vez al importar.
+# El ETag es débil porque se comparte entre la versión comprimida y la sin comprimir
+_INDEX_HTML = index_page_html().replace("__QRCODE_JS__", QRCODE_JS_SRC).encode("utf-8")
+_INDEX_ETAG = '"' + hashlib.blake2b(_INDEX_HTML, digest_size=16).hexdigest() + '"'
+
+@app.get("/")
+async def root(request: Request):
+    """Página principal con interfaz web"""
+    # La compresión la hace GZipMiddleware según el Accept-Encoding del cliente
+    headers = {"ETag": "W/" + _INDEX_ETAG, "Cache-Control": "public, max-age=3600"}
+    if etag_matches(request.headers.get("if-none-match"), _INDEX_ETAG):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=_INDEX_HTML, headers=headers)
 
 @app.get("/version", response_model=VersionResponse)
 async def get_version():
@@ -1879,7 +2475,7 @@ async def list_prints() -> List[PrinterInfo]:
     all_printers.extend(usb_printers)
     
     # Obtener impresoras de red
-    network_printers = get_network_printers()
+    network_printers = await get_network_printers()
     all_printers.extend(network_printers)
     
     # Obtener impresoras del sistema
@@ -1963,7 +2559,8 @@ async def send_printer(request: PrintRequest):
         # Método 1: ESCPOS con Win32Raw (mejor para térmicas)
         try:
             print("Método 1: ESCPOS con Win32Raw (mejor para térmicas)")
-            success, message = print_html(request.printer, request.html)
+            # El render y la escritura bloquean: se hacen fuera del event loop
+            success, message = await asyncio.to_thread(print_html, request.printer, request.html)
             # success, message = print_with_escpos_system(content, request.printer)
             methods_tried.append("ESCPOS")
             if success:
@@ -2021,6 +2618,9 @@ class QRRequest(BaseModel):
     data: str
     size: Optional[int] = 100
 
+class QRBatchRequest(BaseModel):
+    items: List[QRRequest]
+
 # Modelo para procesar HTML con QR
 class ProcessHTMLRequest(BaseModel):
     html: str
@@ -2037,23 +2637,22 @@ async def test_image_print(request: TestImagePrintRequest):
         # Decodificar imagen base64
         if request.base64_image.startswith('data:image'):
             # Remover el prefijo data:image/...;base64,
-            base64_data = request.base64_image.split(',')[1]
+            base64_data = request.base64_image[request.base64_image.index(',') + 1:]
         else:
             base64_data = request.base64_image
-            
-        image_bytes = base64.b64decode(base64_data)
-        image_stream = BytesIO(image_bytes)
-        
-        # Abrir imagen con PIL
-        img = Image.open(image_stream)
+
+        # Decodificar con el mismo decodificador (y caché) que el resto de imágenes;
+        # decodificar e imprimir bloquean, así que se hacen fuera del event loop
+        img = await asyncio.to_thread(decode_base64_image, base64_data, None, None,
+                                      image_format_hint(request.base64_image))
         
         # Imprimir según el tipo de impresora
         if "usb" in request.printer.lower():
-            success, message = print_to_usb(img, "80mm")
+            success, message = await asyncio.to_thread(print_to_usb, img, "80mm")
         elif "network" in request.printer.lower():
-            success, message = print_to_network(img, "80mm")
+            success, message = await asyncio.to_thread(print_to_network, img, "80mm")
         else:
-            success, message = print_with_escpos_system(img, request.printer)
+            success, message = await asyncio.to_thread(print_with_escpos_system, img, request.printer)
             
         return {
             "success": success,
@@ -2092,20 +2691,20 @@ async def serve_test_qr():
         raise HTTPException(status_code=404, detail="Archivo de test no encontrado")
 
 @app.post("/generate_qr")
-async def generate_qr_endpoint(request: QRRequest):
+async def generate_qr_endpoint(request: QRRequest, http_request: Request, response: Response):
     """Generar código QR y devolver como imagen base64"""
+    # Un cliente que ya tiene este QR no necesita que se genere ni se reenvíe
+    etag = qr_etag(request.data, request.size)
+    cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if etag_matches(http_request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+    response.headers.update(cache_headers)
     try:
-        # Generar imagen QR
-        qr_image = generate_qr_image(request.data, (request.size, request.size))
-        
-        if not qr_image:
-            raise HTTPException(status_code=500, detail="Error al generar código QR")
-        
-        # Convertir a base64
-        qr_base64 = qr_to_base64(qr_image)
+        # Generar el QR como data URI (un QR repetido sale de la caché)
+        qr_base64 = await qr_data_uri_async(request.data, request.size)
         
         if not qr_base64:
-            raise HTTPException(status_code=500, detail="Error al convertir QR a base64")
+            raise HTTPException(status_code=500, detail="Error al generar código QR")
         
         return {
             "success": True,
@@ -2113,24 +2712,55 @@ async def generate_qr_endpoint(request: QRRequest):
             "message": "Código QR generado exitosamente"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generando QR: {e}")
         raise HTTPException(status_code=500, detail=f"Error al generar QR: {str(e)}")
 
+@app.post("/generate_qr_batch")
+async def generate_qr_batch_endpoint(request: QRBatchRequest):
+    """Generar varios códigos QR en una sola petición; None en los que fallen"""
+    codes = await asyncio.gather(*(qr_data_uri_async(item.data, item.size) for item in request.items))
+    failed = sum(code is None for code in codes)
+    return {
+        "success": failed == 0,
+        "codes": codes,
+        "message": f"{len(codes) - failed} de {len(codes)} códigos QR generados"
+    }
+
+@app.get("/qr.png")
+async def qr_png_endpoint(request: Request, data: str, size: int = 100):
+    """Código QR como PNG binario, para usar directamente en <img src>"""
+    # Los mismos datos y tamaño dan siempre el mismo PNG: el navegador lo cachea por URL
+    etag = qr_etag(data, size)
+    cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=86400, immutable"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+    png = await qr_png_async(data, size)
+    if png is None:
+        raise HTTPException(status_code=500, detail="Error al generar código QR")
+    return Response(content=png, media_type="image/png", headers=cache_headers)
+
 if __name__ == "__main__":
+    # Necesario en Windows empaquetado para que los procesos del pool de QR no relancen el servidor
+    multiprocessing.freeze_support()
     try:
         import uvicorn
         host = config["api"]["host"]
         port = config["api"]["port"]
         debug = True if config["api"]["debug"] else False
+        # reload vigila los archivos en un proceso aparte: sólo en desarrollo (DEV=1).
+        # Además uvicorn sólo lo admite con la app como "modulo:app", con el objeto termina
+        reload = debug and os.environ.get("DEV", "") == "1"
         print(f"🚀 Iniciando PrintPOS API en http://{host}:{port}")
         print(f"📖 Documentación disponible en http://{host}:{port}/docs")
         print(f"🖨️ Interfaz web disponible en http://{host}:{port}")
         uvicorn.run(
-            app,
+            f"{os.path.splitext(os.path.basename(__file__))[0]}:app" if reload else app,
             host=host,
             port=port,
-            reload=debug,
+            reload=reload,
             log_config=None
         )
     except Exception as e: